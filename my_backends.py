@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Registry of interchangeable backends (tts, speech recognition engines) with a timeout,
+health tracking, fallback to the next backend and latency stats.
+"""
+
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+import my_log
+
+
+# a backend is skipped for COOLDOWN seconds after this number of failures, timeouts or busy calls in a row
+FAILURE_THRESHOLD = 3
+COOLDOWN = 60
+
+
+class Backend:
+    """One engine with a timeout, health tracking, latency and real time factor stats.
+    Every backend runs in its own pool of threads, so calls stuck in one backend do not
+    delay the others. The time waiting for a free thread counts towards the timeout."""
+    def __init__(self, owner: str, name: str, function, timeout: float, workers: int, max_rtf: float, supports):
+        """
+        Args:
+            owner (str): The name of the module for logs.
+            name (str): The name of the backend.
+            function: The function that does the work, returns None or raises if it failed.
+            timeout (float), max_rtf (float): the backend is considered failed for this call
+                after timeout + audio duration * max_rtf seconds.
+            workers (int): The maximum number of calls of the backend at the same time.
+            supports: function(lang) -> bool, whether the backend can work with the language now.
+        """
+        self.lock = threading.Lock()
+        self.owner = owner
+        self.name = name
+        self.function = function
+        self.timeout = timeout
+        self.max_rtf = max_rtf
+        self.supports = supports
+        # a slot is taken until the call really ends, also after the caller stopped waiting for it
+        self.slots = threading.BoundedSemaphore(workers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{owner}_{name}')
+        self.failures_in_row = 0
+        self.disabled_until = 0
+        self.stats_counters = {'calls': 0, 'failures': 0, 'timeouts': 0, 'busy': 0, 'audio_seconds': 0.0}
+        # (latency, real time factor) of the last successful calls
+        self.latencies = collections.deque(maxlen=1000)
+
+    def healthy(self) -> bool:
+        return time.time() >= self.disabled_until
+
+    def record(self, latency: float, duration: float, error: str = '') -> None:
+        """Updates the stats and the health after a call, error is '' for success, 'failure', 'timeout' or 'busy'"""
+        with self.lock:
+            self.stats_counters['calls'] += 1
+            if not error:
+                self.failures_in_row = 0
+                self.stats_counters['audio_seconds'] += duration
+                self.latencies.append((latency, latency / duration if duration else 0))
+                return
+            self.stats_counters[error if error == 'busy' else error + 's'] += 1
+            self.failures_in_row += 1
+            if self.failures_in_row >= FAILURE_THRESHOLD:
+                self.disabled_until = time.time() + COOLDOWN
+                self.failures_in_row = 0
+                my_log.log2(f'{self.owner}: backend {self.name} disabled for {COOLDOWN}s')
+
+    def call(self, *args):
+        try:
+            return self.function(*args)
+        finally:
+            self.slots.release()
+
+    def run(self, *args, duration: float = 0):
+        """
+        Runs the backend with the timeout.
+
+        Args:
+            args: The arguments of the function.
+            duration (float): The duration of the audio in seconds, for the timeout and the real time factor.
+
+        Returns:
+            The result of the function or None if it failed, timed out or the backend was busy.
+        """
+        timeout = self.timeout + duration * self.max_rtf
+        start = time.perf_counter()
+        if not self.slots.acquire(timeout=timeout):
+            self.record(time.perf_counter() - start, duration, 'busy')
+            my_log.log2(f'{self.owner}: backend {self.name} is busy')
+            return None
+        future = self.executor.submit(self.call, *args)
+        try:
+            result = future.result(timeout=max(0, timeout - (time.perf_counter() - start)))
+        except concurrent.futures.TimeoutError:
+            self.record(time.perf_counter() - start, duration, 'timeout')
+            my_log.log2(f'{self.owner}: backend {self.name} timed out after {timeout:.1f}s')
+            return None
+        except Exception as error:
+            self.record(time.perf_counter() - start, duration, 'failure')
+            my_log.log2(f'{self.owner}: backend {self.name} failed: {error!r}')
+            return None
+        if result is None:
+            self.record(time.perf_counter() - start, duration, 'failure')
+            return None
+        self.record(time.perf_counter() - start, duration)
+        return result
+
+    def stats(self) -> dict:
+        """Returns call counters, health, latency and real time factor percentiles"""
+        with self.lock:
+            latencies = sorted(x[0] for x in self.latencies)
+            rtfs = sorted(x[1] for x in self.latencies if x[1])
+            result = dict(self.stats_counters, healthy=self.healthy())
+        result['audio_seconds'] = round(result['audio_seconds'], 1)
+        for name, values in (('latency', latencies), ('rtf', rtfs)):
+            if values:
+                result.update({f'{name}_avg': round(sum(values) / len(values), 3),
+                               f'{name}_p50': round(values[len(values) // 2], 3),
+                               f'{name}_p95': round(values[int(len(values) * 0.95)], 3)})
+        return result
+
+
+class Registry:
+    """Backends of one kind by name, a call goes to the first healthy backend that answers in time"""
+    def __init__(self, owner: str):
+        self.owner = owner
+        # {name: Backend}
+        self.backends = {}
+
+    def __getitem__(self, name: str) -> Backend:
+        return self.backends[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.backends
+
+    def register(self, name: str, function, timeout: float, workers: int = 8, max_rtf: float = 0,
+                 supports=None) -> None:
+        """
+        Registers a backend, a backend with the same name is replaced.
+
+        Args:
+            name (str): The name of the backend.
+            function: The function that does the work, returns None or raises if it failed.
+            timeout (float), max_rtf (float): the next backend is tried after
+                timeout + audio duration * max_rtf seconds.
+            workers (int): The maximum number of calls of the backend at the same time.
+            supports: function(lang) -> bool, whether the backend can work with the language now, all by default.
+        """
+        self.backends[name] = Backend(self.owner, name, function, timeout, workers, max_rtf,
+                                      supports or (lambda lang: True))
+
+    def run(self, order: list, lang: str, *args, duration: float = 0) -> tuple:
+        """
+        Runs the backends of the order that support the language one by one until one succeeds.
+        Unhealthy backends are skipped unless all of them are unhealthy.
+
+        Args:
+            order (list): The names of the backends in order of preference.
+            lang (str): The language, to skip backends that do not support it.
+            args: The arguments of the backend functions.
+            duration (float): The duration of the audio in seconds.
+
+        Returns:
+            tuple: (result, backend name) or (None, '') if all backends failed.
+        """
+        backends = [self.backends[name] for name in order if name in self.backends and self.backends[name].supports(lang)]
+        healthy = [backend for backend in backends if backend.healthy()]
+        for backend in healthy or backends:
+            result = backend.run(*args, duration=duration)
+            if result is not None:
+                return result, backend.name
+        return None, ''
+
+    def stats(self) -> dict:
+        """Returns stats of all backends {name: {calls, failures, timeouts, busy, healthy, latency_*, rtf_*,...}}"""
+        return {name: backend.stats() for name, backend in self.backends.items()}
@@ -1,25 +1,472 @@
 #!/usr/bin/env python3
 
 
+import collections
+import hashlib
+import itertools
+import os
+import queue
+import random
+import re
 import threading
+import time
+
 import requests
+import requests.adapters
 
 from bardapi import Bard
 
+import my_dic
 import my_log
 
 
-# storage for sessions {chat_id(int):session(bardapi.Bard),...}
-DIALOGS = {}
+# folder for permanent dictionaries, bot memory
+if not os.path.exists('db'):
+    os.mkdir('db')
+
+
 # lock storage so that users cannot make new requests until a response to the old one is received
 # {chat_id(str):threading.Lock(),...}
 CHAT_LOCKS = {}
+# protects CHAT_LOCKS from adding and removing locks at the same time
+CHAT_LOCKS_LOCK = threading.Lock()
 
 # the maximum request size that the bard accepts is obtained by selection
 MAX_REQUEST = 3100
 
+# sessions that were not used for this number of seconds are removed from memory
+DIALOG_TTL = 60 * 60
+# maximum number of sessions kept in memory, least recently used are removed first
+MAX_DIALOGS = 1000
+
+# send the user's name and locale together with the first query of a new session
+# instead of a separate priming request
+PRIME_IN_QUERY = True
+# create sessions for recently active chats in the background after /clear and restart
+PREWARM = True
+# chats that were active during this number of seconds before restart are prewarmed
+PREWARM_RECENT_TIME = 60 * 60
+# maximum number of chats prewarmed after restart
+PREWARM_MAX = 50
+# saved conversations of chats idle for this number of seconds are removed from SESSIONS_DB at start
+SESSIONS_TTL = 30 * 24 * 60 * 60
+
+# 'thread' - bardapi.Bard in the calling thread, 'async' - my_bard_async engine,
+# the calling thread only waits for the result
+ENGINE = 'thread'
+
+# messages that arrive while a request of the same dialog is running are sent
+# to bard together as one request with one answer
+COALESCE = False
+
+# maximum number of bard requests at the same time for all dialogs
+MAX_CONCURRENT = 30
+# maximum number of bard requests at the same time with one token, chats can share a token with /token copy
+MAX_PER_TOKEN = 3
+# a message that waited in the queue for this number of seconds is answered with a 'busy' reply
+MAX_QUEUE_WAIT = 60
+
+# maximum number of keep-alive connections to bard shared by all sessions of the thread engine,
+# requests wait for a free connection when all of them are busy
+POOL_SIZE = 20
+
+
+class SessionCache:
+    """LRU storage for bard sessions {chat_id(int):session(bardapi.Bard),...}
+    Removes sessions that were idle longer than ttl seconds and least recently used sessions
+    when there are more than max_entries of them. A session is never removed while its chat lock is held."""
+    def __init__(self, max_entries: int, ttl: int, locks: dict = CHAT_LOCKS, locks_lock: threading.Lock = CHAT_LOCKS_LOCK):
+        """
+        Args:
+            max_entries (int): maximum number of sessions.
+            ttl (int): idle time in seconds after which a session is removed.
+            locks (dict): chat locks {chat_id:lock,...}, locks of removed sessions are removed too.
+            locks_lock (threading.Lock): the lock that protects locks dict.
+        """
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.locks = locks
+        self.locks_lock = locks_lock
+        # {dialog: [session, last used time]}
+        self.sessions = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, dialog) -> bool:
+        with self.lock:
+            return dialog in self.sessions
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.sessions)
+
+    def __getitem__(self, dialog) -> Bard:
+        session = self.get(dialog)
+        if session is None:
+            raise KeyError(dialog)
+        return session
+
+    def get(self, dialog) -> Bard:
+        """Returns the session and marks it as recently used, or None if there is no session"""
+        with self.lock:
+            self.evict()
+            if dialog not in self.sessions:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.sessions.move_to_end(dialog)
+            item = self.sessions[dialog]
+            item[1] = time.time()
+            return item[0]
+
+    def __setitem__(self, dialog, session: Bard):
+        with self.lock:
+            self.sessions[dialog] = [session, time.time()]
+            self.sessions.move_to_end(dialog)
+            self.evict()
+
+    def __delitem__(self, dialog):
+        with self.lock:
+            del self.sessions[dialog]
+
+    def evict(self) -> None:
+        """Removes expired and extra sessions, must be called with the lock held"""
+        now = time.time()
+        # number of busy sessions at the beginning of the queue
+        skipped = 0
+        with self.locks_lock:
+            while len(self.sessions) > skipped:
+                dialog = next(itertools.islice(self.sessions, skipped, None))
+                expired = now - self.sessions[dialog][1] > self.ttl
+                if not expired and len(self.sessions) <= self.max_entries:
+                    break
+                chat_lock = self.locks.get(dialog)
+                if chat_lock and chat_lock.locked():
+                    skipped += 1
+                    continue
+                session = self.sessions.pop(dialog)[0]
+                self.locks.pop(dialog, None)
+                self.evictions += 1
+                if hasattr(session, 'session'):
+                    try:
+                        session.session.close()
+                    except Exception as error:
+                        my_log.log2(f'my_bard:SessionCache:evict: {error}')
+
+    def stats(self) -> dict:
+        """Returns the number of sessions and hit, miss and eviction counters"""
+        with self.lock:
+            return {'sessions': len(self.sessions), 'locks': len(self.locks), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class SharedAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter that is mounted to all bard sessions so that they use one size-bounded pool
+    of keep-alive connections, cookies and headers stay separate in each session.
+    Counts requests, new connections and requests that found the pool saturated."""
+    def __init__(self, pool_size: int):
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+        self.pool_size = pool_size
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.saturated = 0
+
+    def send(self, request, **kwargs):
+        with self.stats_lock:
+            self.requests += 1
+            if self.in_flight >= self.pool_size:
+                self.saturated += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            with self.stats_lock:
+                self.in_flight -= 1
+
+    def close(self):
+        """Sessions close their adapters when they are removed, the shared pool must stay open"""
+        pass
+
+    def stats(self) -> dict:
+        """Returns pool usage, reuse_rate is the share of requests sent over an already open connection"""
+        pools = [self.poolmanager.pools[x] for x in self.poolmanager.pools.keys()]
+        connections = sum(x.num_connections for x in pools)
+        with self.stats_lock:
+            return {'pool_size': self.pool_size, 'requests': self.requests, 'connections': connections,
+                    'reuse_rate': 1 - connections / self.requests if self.requests else 0,
+                    'in_flight': self.in_flight, 'max_in_flight': self.max_in_flight,
+                    'saturated': self.saturated}
+
+
+# connection pool of all bard sessions
+ADAPTER = SharedAdapter(POOL_SIZE)
+
+
+class RetryPolicy:
+    """The only place where retries of bard requests are decided, used by both engines.
+    Limits the number of attempts and the total time, waits with exponential backoff and full jitter,
+    does not retry auth errors and waits longer when bard throttles requests."""
+    def __init__(self, attempts: int = 3, base_delay: float = 1, max_delay: float = 10,
+                 throttled_delay: float = 5, max_time: float = 90):
+        """
+        Args:
+            attempts (int): maximum number of attempts for one user message, including the first one.
+            base_delay (float): delay before the second attempt in seconds, doubled for each next one.
+            max_delay (float): maximum delay between attempts in seconds.
+            throttled_delay (float): base delay when bard answered with 'too many requests'.
+            max_time (float): no new attempts are started after this number of seconds.
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttled_delay = throttled_delay
+        self.max_time = max_time
+
+    def classify(self, error: Exception) -> str:
+        """Returns 'auth' for a bad token, 'throttled' for rate limits and 'transient' for other errors"""
+        status = getattr(getattr(error, 'response', None), 'status_code', None) or getattr(error, 'status', None)
+        text = str(error)
+        if not status:
+            # bardapi raises a plain Exception('Response status code is not 200. Response Status is 429')
+            match = re.search(r'Response Status is (\d{3})', text, re.IGNORECASE)
+            if match:
+                status = int(match.group(1))
+        if status in (401, 403) or 'SNlM0e' in text or '__Secure-1PSID' in text:
+            return 'auth'
+        if status == 429 or 'Too Many Requests' in text:
+            return 'throttled'
+        return 'transient'
+
+    def retry(self, attempt: int, kind: str, start_time: float) -> bool:
+        """Whether one more attempt is allowed after the failed attempt number attempt (from 0)"""
+        if kind == 'auth' or attempt + 1 >= self.attempts:
+            return False
+        return time.time() - start_time + self.delay_limit(attempt, kind) < self.max_time
+
+    def delay_limit(self, attempt: int, kind: str) -> float:
+        base = self.throttled_delay if kind == 'throttled' else self.base_delay
+        return min(self.max_delay, base * 2 ** attempt)
+
+    def delay(self, attempt: int, kind: str) -> float:
+        """Returns the delay before the next attempt, random so that many users do not retry at once"""
+        return random.uniform(self.delay_limit(attempt, kind) / 2, self.delay_limit(attempt, kind))
+
+    def log_attempt(self, name: str, attempt: int, latency: float, error: Exception = None, kind: str = '') -> None:
+        """Logs failed attempts and successful retries with their latency"""
+        if error:
+            print(f'{name}: attempt {attempt + 1} failed in {latency:.2f}s [{kind}]: {error}')
+            my_log.log2(f'{name}: attempt {attempt + 1} failed in {latency:.2f}s [{kind}]: {error}')
+        elif attempt:
+            my_log.log2(f'{name}: attempt {attempt + 1} succeeded in {latency:.2f}s')
+
+
+# retry policy of all bard requests
+RETRY = RetryPolicy()
+
+
+class BusyError(Exception):
+    """The message waited for a free slot longer than MAX_QUEUE_WAIT"""
+    pass
+
+
+class Scheduler:
+    """Admission control in front of bard requests. Limits the number of requests at the same time
+    globally and per token, gives free slots to dialogs in turn so that a busy group does not starve
+    other chats, one dialog has at most one request running."""
+    def __init__(self, max_concurrent: int, max_per_token: int, max_wait: float):
+        self.max_concurrent = max_concurrent
+        self.max_per_token = max_per_token
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        # waiting messages in round-robin order of dialogs {dialog: deque([ticket,...]),...}
+        self.queues = collections.OrderedDict()
+        self.active_dialogs = set()
+        self.active_tokens = collections.Counter()
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def dispatch(self) -> None:
+        """Gives free slots to waiting dialogs in turn, must be called with the condition held"""
+        granted = False
+        for dialog in list(self.queues):
+            if self.running >= self.max_concurrent:
+                break
+            if dialog in self.active_dialogs:
+                continue
+            ticket = self.queues[dialog][0]
+            if self.active_tokens[ticket['token']] >= self.max_per_token:
+                continue
+            self.queues[dialog].popleft()
+            if self.queues[dialog]:
+                # served dialogs go to the end of the line
+                self.queues.move_to_end(dialog)
+            else:
+                del self.queues[dialog]
+            ticket['granted'] = True
+            self.running += 1
+            self.waiting -= 1
+            self.active_dialogs.add(dialog)
+            self.active_tokens[ticket['token']] += 1
+            granted = True
+        if granted:
+            self.cond.notify_all()
+
+    def acquire(self, dialog, token: str) -> None:
+        """
+        Waits for a slot, raises BusyError after max_wait seconds of waiting for the global or per token limits.
+        The time waiting behind earlier messages of the same dialog is not limited, they are
+        answered one by one anyway.
+        """
+        ticket = {'token': token, 'granted': False}
+        start = time.time()
+        with self.cond:
+            self.queues.setdefault(dialog, collections.deque()).append(ticket)
+            self.waiting += 1
+            self.dispatch()
+            # seconds the ticket was next in its dialog and the dialog was idle, but there was no free slot
+            blocked = 0.0
+            last_check = time.time()
+            while not ticket['granted']:
+                now = time.time()
+                eligible = self.queues[dialog][0] is ticket and dialog not in self.active_dialogs
+                if eligible:
+                    blocked += now - last_check
+                last_check = now
+                remaining = self.max_wait - blocked
+                if eligible and remaining <= 0:
+                    self.queues[dialog].remove(ticket)
+                    if not self.queues[dialog]:
+                        del self.queues[dialog]
+                    self.waiting -= 1
+                    self.rejected += 1
+                    raise BusyError(f'my_bard:Scheduler: waited {self.max_wait}s for dialog {dialog}')
+                self.cond.wait(remaining if eligible else self.max_wait)
+            waited = time.time() - start
+            self.admitted += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def release(self, dialog, token: str) -> None:
+        """Frees the slot of the dialog"""
+        with self.cond:
+            self.running -= 1
+            self.active_dialogs.discard(dialog)
+            self.active_tokens[token] -= 1
+            if not self.active_tokens[token]:
+                del self.active_tokens[token]
+            self.dispatch()
+            # the next message of the dialog starts counting its wait now even if it got no slot
+            self.cond.notify_all()
+
+    def stats(self) -> dict:
+        """Returns queue depth, running requests and wait times in seconds"""
+        with self.cond:
+            return {'queue_depth': self.waiting, 'queued_dialogs': len(self.queues), 'running': self.running,
+                    'admitted': self.admitted, 'rejected': self.rejected,
+                    'wait_avg': self.wait_total / self.admitted if self.admitted else 0,
+                    'wait_max': self.wait_max}
+
+
+# admission control of all bard requests
+SCHEDULER = Scheduler(MAX_CONCURRENT, MAX_PER_TOKEN, MAX_QUEUE_WAIT)
+
+# messages waiting for the dialog lock {chat_id(int):[[query(str), served(bool)],...],...}
+PENDING = {}
+PENDING_LOCK = threading.Lock()
+# 'requests' - requests sent to bard, 'messages' - messages in them, saved requests = messages - requests
+COALESCE_STATS = {'requests': 0, 'messages': 0}
+
+
+def coalesce_add(dialog, query: str) -> list:
+    """Adds the message to the queue of the dialog, must be called before waiting for the dialog lock"""
+    item = [query, False]
+    with PENDING_LOCK:
+        PENDING.setdefault(dialog, []).append(item)
+    return item
+
+
+def coalesce_take(dialog, item: list) -> str:
+    """
+    Takes the message and the messages that came after it from the queue of the dialog,
+    must be called with the dialog lock held.
+
+    Returns:
+        str: The combined query not longer than MAX_REQUEST, or None if the message
+             was already sent to bard with another message.
+    """
+    with PENDING_LOCK:
+        if item[1]:
+            return None
+        pending = PENDING[dialog]
+        batch = [item]
+        size = len(item[0])
+        for x in pending[pending.index(item) + 1:]:
+            if size + 2 + len(x[0]) > MAX_REQUEST:
+                break
+            batch.append(x)
+            size += 2 + len(x[0])
+        for x in batch:
+            x[1] = True
+            pending.remove(x)
+        if not pending:
+            del PENDING[dialog]
+        COALESCE_STATS['requests'] += 1
+        COALESCE_STATS['messages'] += len(batch)
+    return '\n\n'.join(x[0] for x in batch)
+
+
+def coalesce_remove(dialog, item: list) -> bool:
+    """
+    Removes the message from the queue of the dialog if it was not sent yet.
 
-def get_new_session(token: str, lang: str, user_name: str) -> Bard:
+    Returns:
+        bool: True if the message was removed, False if it was already sent with another message.
+    """
+    with PENDING_LOCK:
+        if item[1]:
+            return False
+        PENDING[dialog].remove(item)
+        if not PENDING[dialog]:
+            del PENDING[dialog]
+    return True
+
+
+def coalesce_stats() -> dict:
+    """Returns the number of requests and messages sent to bard and the number of saved requests"""
+    with PENDING_LOCK:
+        return dict(COALESCE_STATS, saved=COALESCE_STATS['messages'] - COALESCE_STATS['requests'])
+
+# storage for sessions {chat_id(int):session(bardapi.Bard),...}
+DIALOGS = SessionCache(MAX_DIALOGS, DIALOG_TTL)
+
+# state of recently active chats, used to resume conversations after restart
+# {chat_id(int):{'token_hash':str, 'lang':str, 'user_name':str, 'time':float,
+#                'conversation_id':str, 'response_id':str, 'choice_id':str, '_reqid':int},...}
+SESSIONS_DB = my_dic.PersistentDict('db/bard_sessions.pkl', journal=True)
+# attributes of bardapi.Bard that are needed to continue a conversation
+STATE_ATTRS = ('conversation_id', 'response_id', 'choice_id', '_reqid')
+# how many sessions were resumed from SESSIONS_DB and how many were created from scratch since start
+RESUME_STATS = {'resumed': 0, 'recreated': 0, 'pruned': 0}
+
+# queue of chats for the prewarm thread [(chat_id, token, lang, user_name),...]
+PREWARM_QUEUE = queue.Queue()
+
+
+def get_rules(lang: str, user_name: str) -> str:
+    """Returns the text that tells bard the name and the locale of the user"""
+    return f"You are talking to user with name [{user_name}] and user's locale is [{lang}]. Take care about the name, gender and locale of the user."
+
+
+def get_new_session(token: str, lang: str, user_name: str, prime: bool = True) -> Bard:
     """
     Creates a new session for interacting with the Bard API.
 
@@ -27,11 +474,14 @@ def get_new_session(token: str, lang: str, user_name: str) -> Bard:
         token (str): The authentication token for the session.
         lang (str): The language of the user.
         user_name (str): The name of the user.
+        prime (bool, optional): Whether to send the user's name and locale in a separate request.
+                                Defaults to True.
 
     Returns:
         Bard: An instance of the Bard class representing the session.
     """
     session = requests.Session()
+    session.mount('https://', ADAPTER)
 
     session.cookies.set("__Secure-1PSID", token)
 
@@ -46,13 +496,154 @@ def get_new_session(token: str, lang: str, user_name: str) -> Bard:
 
     bard = Bard(token=token, session=session, timeout=30)
 
-    rules = f"You are talking to user with name [{user_name}] and user's locale is [{lang}]. Take care about the name, gender and locale of the user. Say OK if got."
-
-    r = bard.get_answer(rules)
+    if prime:
+        r = bard.get_answer(get_rules(lang, user_name) + ' Say OK if got.')
 
     return bard
 
 
+def new_session_query(query: str, token: str, lang: str, user_name: str) -> tuple:
+    """
+    Creates a new session and the query to send to it. If PRIME_IN_QUERY is set and the result
+    fits in MAX_REQUEST the user's name and locale are added to the query, otherwise
+    the session is primed with a separate request.
+
+    Returns:
+        tuple: (bardapi.Bard, str) the session and the query.
+    """
+    rules = get_rules(lang, user_name)
+    if PRIME_IN_QUERY and len(rules) + len(query) + 2 <= MAX_REQUEST:
+        return get_new_session(token, lang, user_name, prime=False), f'{rules}\n\n{query}'
+    return get_new_session(token, lang, user_name), query
+
+
+def token_hash(token: str) -> str:
+    """Returns a hash of the token, the token itself is not saved with the session state"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def save_state(dialog, session: Bard, token: str, lang: str, user_name: str) -> None:
+    """Saves the state of the conversation to SESSIONS_DB so that it can be resumed after restart"""
+    record = {'token_hash': token_hash(token), 'lang': lang, 'user_name': user_name, 'time': time.time()}
+    for attr in STATE_ATTRS:
+        record[attr] = getattr(session, attr, None)
+    SESSIONS_DB[dialog] = record
+
+
+def prune_sessions() -> int:
+    """Removes saved conversations of chats that were idle longer than SESSIONS_TTL, returns their number"""
+    now = time.time()
+    old = [dialog for dialog, record in SESSIONS_DB.items() if now - record['time'] > SESSIONS_TTL]
+    for dialog in old:
+        del SESSIONS_DB[dialog]
+    RESUME_STATS['pruned'] += len(old)
+    return len(old)
+
+
+def restore_session(dialog, token: str, lang: str, user_name: str) -> Bard:
+    """
+    Creates a session that continues the saved conversation of the dialog without priming.
+
+    Returns:
+        Bard: The session, or None if there is no saved conversation for the same token, locale and name.
+    """
+    record = SESSIONS_DB.get(dialog)
+    if (not record or not record.get('conversation_id') or record['token_hash'] != token_hash(token) or
+        record['lang'] != lang or record['user_name'] != user_name):
+        return None
+    session = get_new_session(token, lang, user_name, prime=False)
+    for attr in STATE_ATTRS:
+        if record.get(attr) is not None:
+            setattr(session, attr, record[attr])
+    return session
+
+
+def resume_or_create_session(dialog, query: str, token: str, lang: str, user_name: str) -> tuple:
+    """
+    Resumes the saved conversation of the dialog or creates a new session.
+
+    Returns:
+        tuple: (bardapi.Bard, str) the session and the query to send to it.
+    """
+    session = restore_session(dialog, token, lang, user_name)
+    if session is not None:
+        RESUME_STATS['resumed'] += 1
+        return session, query
+    RESUME_STATS['recreated'] += 1
+    return new_session_query(query, token, lang, user_name)
+
+
+def prewarm_worker() -> None:
+    """Creates sessions from PREWARM_QUEUE one by one, so that users do not wait for it"""
+    while True:
+        dialog, token, lang, user_name = PREWARM_QUEUE.get()
+        if dialog in DIALOGS:
+            continue
+        try:
+            session = restore_session(dialog, token, lang, user_name)
+            if session is not None:
+                RESUME_STATS['resumed'] += 1
+            else:
+                session = get_new_session(token, lang, user_name)
+                RESUME_STATS['recreated'] += 1
+        except Exception as error:
+            my_log.log2(f'my_bard:prewarm_worker: {error}')
+            continue
+        # the user could start a new session while this one was created
+        if dialog not in DIALOGS:
+            DIALOGS[dialog] = session
+
+
+def prewarm(dialog, token: str, lang: str, user_name: str) -> None:
+    """
+    Adds the chat to the prewarm queue, a new session will be created in the background.
+
+    Args:
+        dialog (str): The ID of the dialog.
+        token (str): The authentication token for the bot.
+        lang (str): The language code for the dialog.
+        user_name (str): The name of the user chatting with the bot.
+    """
+    if PREWARM and token and ENGINE == 'thread':
+        PREWARM_QUEUE.put((dialog, token, lang, user_name))
+
+
+def prewarm_recent(get_token) -> int:
+    """
+    Adds chats that were active during PREWARM_RECENT_TIME to the prewarm queue, used after restart.
+
+    Args:
+        get_token (function): Returns the current token of the chat, tokens are not kept in SESSIONS_DB.
+
+    Returns:
+        int: The number of queued chats.
+    """
+    now = time.time()
+    recent = [(v['time'], k, v) for k, v in SESSIONS_DB.items() if now - v['time'] < PREWARM_RECENT_TIME]
+    recent = sorted(recent, key=lambda x: x[0], reverse=True)[:PREWARM_MAX]
+    for _, dialog, record in recent:
+        prewarm(dialog, get_token(dialog), record['lang'], record['user_name'])
+    return len(recent)
+
+
+def resume_stats() -> dict:
+    """Returns how many sessions were resumed and how many were created from scratch since start"""
+    return dict(RESUME_STATS, saved=len(SESSIONS_DB))
+
+
+def pool_stats() -> dict:
+    """Returns usage of the shared connection pool of the current engine"""
+    if ENGINE == 'async':
+        import my_bard_async
+        return my_bard_async.pool_stats()
+    return ADAPTER.stats()
+
+
+threading.Thread(target=prewarm_worker, daemon=True).start()
+# records of long idle chats are not kept and replayed on every start
+prune_sessions()
+
+
 def reset_bard_chat(dialog: str):
     """
     Deletes a specific dialog from the DIALOGS dictionary.
@@ -63,6 +654,12 @@ def reset_bard_chat(dialog: str):
     Returns:
         None
     """
+    if ENGINE == 'async':
+        import my_bard_async
+        my_bard_async.reset_bard_chat(dialog)
+        return
+    # a new dialog must not be resumed after restart
+    SESSIONS_DB.pop(dialog)
     try:
         del DIALOGS[dialog]
     except KeyError:
@@ -93,32 +690,33 @@ def chat_request(query: str, dialog: str, token: str, lang: str, user_name: str,
         reset_bard_chat(dialog)
         return
 
-    if dialog in DIALOGS:
-        session = DIALOGS[dialog]
-    else:
-        session = get_new_session(token, lang, user_name)
-        DIALOGS[dialog] = session
-
-    try:
-        response = session.get_answer(query)
-    except Exception as error:
-        print(error)
-        my_log.log2(str(error))
-
+    response = None
+    start_time = time.time()
+    for attempt in range(RETRY.attempts):
+        attempt_start = time.time()
         try:
-            del DIALOGS[dialog]
-            session = get_new_session(token, lang, user_name)
-            DIALOGS[dialog] = session
-        except KeyError:
-            print(f'no such key in DIALOGS: {dialog}')
-            my_log.log2(f'my_bard.py:chat_request:no such key in DIALOGS: {dialog}')
-
-        try:
-            response = session.get_answer(query)
-        except Exception as error2:
-            print(error2)
-            my_log.log2(str(error2))
-            return ''
+            request = query
+            session = DIALOGS.get(dialog)
+            if session is None:
+                if attempt == 0:
+                    session, request = resume_or_create_session(dialog, query, token, lang, user_name)
+                else:
+                    # the saved state may be the cause of the error, start from scratch
+                    session, request = new_session_query(query, token, lang, user_name)
+                DIALOGS[dialog] = session
+            response = session.get_answer(request)
+            RETRY.log_attempt(f'my_bard:chat_request:{dialog}', attempt, time.time() - attempt_start)
+            break
+        except Exception as error:
+            kind = RETRY.classify(error)
+            RETRY.log_attempt(f'my_bard:chat_request:{dialog}', attempt, time.time() - attempt_start, error, kind)
+            try:
+                del DIALOGS[dialog]
+            except KeyError:
+                pass
+            if not RETRY.retry(attempt, kind, start_time):
+                return ''
+            time.sleep(RETRY.delay(attempt, kind))
 
     result = response['content']
 
@@ -128,6 +726,8 @@ def chat_request(query: str, dialog: str, token: str, lang: str, user_name: str,
         reset_bard_chat(dialog)
         return 'key error'
 
+    save_state(dialog, session, token, lang, user_name)
+
     return result[:4096]
 
 
@@ -144,25 +744,51 @@ def chat(query: str, dialog: str, token: str, lang: str, user_name: str, reset:
         reset (bool, optional): Whether to reset the dialog. Defaults to False.
 
     Returns:
-        str: The response message from the bot.
+        str: The response message from the bot, None if COALESCE is set and the message was sent
+             to bard together with a previous message, the answer is returned for that message.
+
+    Raises:
+        BusyError: If the message waited in the queue longer than MAX_QUEUE_WAIT.
     """
-    if dialog in CHAT_LOCKS:
-        lock = CHAT_LOCKS[dialog]
-    else:
-        lock = threading.Lock()
-        CHAT_LOCKS[dialog] = lock
+    if reset:
+        reset_bard_chat(dialog)
+        return
+
+    item = coalesce_add(dialog, query) if COALESCE else None
+    try:
+        SCHEDULER.acquire(dialog, token)
+    except BusyError:
+        if item and not coalesce_remove(dialog, item):
+            return None
+        raise
+    try:
+        if ENGINE == 'async':
+            import my_bard_async
+            return my_bard_async.chat(query, dialog, token, lang, user_name, item=item)
+        return chat_thread(query, dialog, token, lang, user_name, item)
+    finally:
+        SCHEDULER.release(dialog, token)
+
+
+def chat_thread(query: str, dialog: str, token: str, lang: str, user_name: str, item: list = None) -> str:
+    """Thread engine of chat(), item is the message in the coalescing queue if COALESCE is set"""
+    with CHAT_LOCKS_LOCK:
+        if dialog in CHAT_LOCKS:
+            lock = CHAT_LOCKS[dialog]
+        else:
+            lock = threading.Lock()
+            CHAT_LOCKS[dialog] = lock
     result = ''
     with lock:
+        if item:
+            query = coalesce_take(dialog, item)
+            if query is None:
+                return None
         try:
-            result = chat_request(query, dialog, token, lang, user_name, reset)
+            result = chat_request(query, dialog, token, lang, user_name)
         except Exception as error:
             print(f'my_bard:chat: {error}')
             my_log.log2(f'my_bard:chat: {error}')
-            try:
-                result = chat_request(query, dialog, token, lang, user_name, reset)
-            except Exception as error2:
-                print(f'my_bard:chat:2: {error2}')
-                my_log.log2(f'my_bard:chat:2: {error2}')
     return result
 
 
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+
+import asyncio
+import json
+import random
+import re
+import string
+import threading
+import time
+
+import aiohttp
+
+import my_bard
+import my_log
+
+
+# bard server, can be changed to a local stub server for tests
+BASE_URL = 'https://bard.google.com'
+
+# maximum number of requests to bard at the same time for all dialogs
+MAX_CONCURRENCY = 100
+
+# timeout for one request to bard
+TIMEOUT = 30
+
+HEADERS = {
+    "Host": "bard.google.com",
+    "X-Same-Domain": "1",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36",
+    "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8",
+    "Origin": "https://bard.google.com",
+    "Referer": "https://bard.google.com/",
+    }
+
+# lock storage so that users cannot make new requests until a response to the old one is received
+# {chat_id(str):asyncio.Lock(),...}, used only from the event loop thread
+CHAT_LOCKS = {}
+CHAT_LOCKS_LOCK = threading.Lock()
+
+# storage for sessions {chat_id(int):session(AsyncSession),...}
+DIALOGS = my_bard.SessionCache(my_bard.MAX_DIALOGS, my_bard.DIALOG_TTL, CHAT_LOCKS, CHAT_LOCKS_LOCK)
+
+# event loop that runs all requests, started in a separate thread on first use
+LOOP = None
+LOOP_LOCK = threading.Lock()
+# shared http client and the global concurrency limit, created in the event loop
+CLIENT = None
+SEMAPHORE = None
+# usage of the connection pool of the shared client
+POOL_STATS = {'requests': 0, 'connections': 0, 'reused': 0, 'queued': 0}
+
+
+def build_request(query: str, snlm0e: str, reqid: int, conversation_id: str, response_id: str,
+                  choice_id: str) -> tuple:
+    """
+    Builds the parameters and the form data of a bard StreamGenerate request.
+
+    Returns:
+        tuple: (params dict, data dict)
+    """
+    params = {"bl": "boq_assistant-bard-web-server_20230419.00_p1", "_reqid": str(reqid), "rt": "c"}
+    input_text_struct = [[query], None, [conversation_id, response_id, choice_id]]
+    data = {"f.req": json.dumps([None, json.dumps(input_text_struct)]), "at": snlm0e}
+    return params, data
+
+
+def parse_response(content: bytes) -> dict:
+    """
+    Parses the answer of a bard StreamGenerate request the same way as bardapi.Bard does.
+
+    Returns:
+        dict: {'content':str, 'conversation_id':str, 'response_id':str, 'choice_id':str, 'links':list}
+              or {'content':str} with the error if bard did not answer.
+    """
+    resp_dict = json.loads(content.splitlines()[3])[0][2]
+    if not resp_dict:
+        return {"content": f"Response Error: {content}. "}
+    parsed_answer = json.loads(resp_dict)
+    links = []
+    for choice in parsed_answer[4]:
+        links += re.findall(r'https?://[^\s"\'\]\\]+', json.dumps(choice))
+    return {"content": parsed_answer[4][0][1][0],
+            "conversation_id": parsed_answer[1][0],
+            "response_id": parsed_answer[1][1],
+            "choice_id": parsed_answer[4][0][0],
+            "links": links}
+
+
+def parse_snlm0e(text: str) -> str:
+    """Returns the SNlM0e value from the bard start page"""
+    snlm0e = re.search(r"SNlM0e\":\"(.*?)\"", text)
+    if not snlm0e:
+        raise Exception("SNlM0e value not found in response. Check __Secure-1PSID value.")
+    return snlm0e.group(1)
+
+
+class AsyncSession:
+    """Bard conversation of one dialog, requests are sent with the shared http client.
+    Has the same state attributes as bardapi.Bard so my_bard.save_state works with it."""
+    def __init__(self, token: str):
+        self.token = token
+        self.SNlM0e = ''
+        self.conversation_id = ''
+        self.response_id = ''
+        self.choice_id = ''
+        self._reqid = int(''.join(random.choices(string.digits, k=4)))
+
+    async def get_answer(self, query: str) -> dict:
+        """Sends the query to bard and returns the parsed answer"""
+        headers = dict(HEADERS, Cookie=f'__Secure-1PSID={self.token}')
+        async with SEMAPHORE:
+            if not self.SNlM0e:
+                async with CLIENT.get(f'{BASE_URL}/', headers=headers) as resp:
+                    resp.raise_for_status()
+                    self.SNlM0e = parse_snlm0e(await resp.text())
+            params, data = build_request(query, self.SNlM0e, self._reqid, self.conversation_id,
+                                         self.response_id, self.choice_id)
+            async with CLIENT.post(f'{BASE_URL}/_/BardChatUi/data/assistant.lamda.BardFrontendService/StreamGenerate',
+                                   params=params, data=data, headers=headers) as resp:
+                resp.raise_for_status()
+                content = await resp.read()
+        answer = parse_response(content)
+        if 'conversation_id' in answer:
+            self.conversation_id = answer['conversation_id']
+            self.response_id = answer['response_id']
+            self.choice_id = answer['choice_id']
+            self._reqid += 100000
+        return answer
+
+
+async def new_session(dialog, query: str, token: str, lang: str, user_name: str, resume: bool = True) -> tuple:
+    """
+    Resumes the saved conversation of the dialog or creates a new session.
+    The user's name and locale are sent with the first query of a new session.
+
+    Returns:
+        tuple: (AsyncSession, str) the session and the query to send to it.
+    """
+    session = AsyncSession(token)
+    record = my_bard.SESSIONS_DB.get(dialog) if resume else None
+    if (record and record.get('conversation_id') and record['token_hash'] == my_bard.token_hash(token) and
+        record['lang'] == lang and record['user_name'] == user_name):
+        for attr in my_bard.STATE_ATTRS:
+            if record.get(attr) is not None:
+                setattr(session, attr, record[attr])
+        my_bard.RESUME_STATS['resumed'] += 1
+        return session, query
+    my_bard.RESUME_STATS['recreated'] += 1
+    rules = my_bard.get_rules(lang, user_name)
+    if my_bard.PRIME_IN_QUERY and len(rules) + len(query) + 2 <= my_bard.MAX_REQUEST:
+        return session, f'{rules}\n\n{query}'
+    await session.get_answer(rules + ' Say OK if got.')
+    return session, query
+
+
+async def chat_request(query: str, dialog, token: str, lang: str, user_name: str) -> str:
+    """
+    Executes a chat request, the same as my_bard.chat_request but without blocking a thread.
+
+    Returns:
+        str: The response from bard, limited to 4096 characters.
+    """
+    retry = my_bard.RETRY
+    start_time = time.time()
+    for attempt in range(retry.attempts):
+        attempt_start = time.time()
+        try:
+            request = query
+            session = DIALOGS.get(dialog)
+            if session is None:
+                # the saved state may be the cause of the error, do not resume it on retries
+                session, request = await new_session(dialog, query, token, lang, user_name, resume=attempt == 0)
+                DIALOGS[dialog] = session
+            response = await session.get_answer(request)
+            retry.log_attempt(f'my_bard_async:chat_request:{dialog}', attempt, time.time() - attempt_start)
+            break
+        except Exception as error:
+            kind = retry.classify(error)
+            retry.log_attempt(f'my_bard_async:chat_request:{dialog}', attempt, time.time() - attempt_start, error, kind)
+            try:
+                del DIALOGS[dialog]
+            except KeyError:
+                pass
+            if not retry.retry(attempt, kind, start_time):
+                return ''
+            await asyncio.sleep(retry.delay(attempt, kind))
+
+    if 'links' not in response:
+        reset_bard_chat(dialog)
+        return 'key error'
+
+    my_bard.save_state(dialog, session, token, lang, user_name)
+
+    return response['content'][:4096]
+
+
+async def chat_async(query: str, dialog, token: str, lang: str, user_name: str, item: list = None) -> str:
+    """
+    Chat with bard from a coroutine, requests of one dialog are sent one by one.
+
+    Args:
+        query (str): The query message to send to the bot.
+        dialog (str): The ID of the dialog to chat with.
+        token (str): The authentication token for the bot.
+        lang (str): The language code for the dialog.
+        user_name (str): The name of the user chatting with the bot.
+        item (list, optional): The message in the coalescing queue if it was already added by my_bard.chat.
+
+    Returns:
+        str: The response message from the bot, None if the message was coalesced, see my_bard.chat.
+    """
+    if my_bard.COALESCE and item is None:
+        item = my_bard.coalesce_add(dialog, query)
+    with CHAT_LOCKS_LOCK:
+        if dialog not in CHAT_LOCKS:
+            CHAT_LOCKS[dialog] = asyncio.Lock()
+        lock = CHAT_LOCKS[dialog]
+    async with lock:
+        if item:
+            query = my_bard.coalesce_take(dialog, item)
+            if query is None:
+                return None
+        try:
+            return await chat_request(query, dialog, token, lang, user_name)
+        except Exception as error:
+            print(f'my_bard_async:chat: {error}')
+            my_log.log2(f'my_bard_async:chat: {error}')
+            return ''
+
+
+async def count_request(session, context, params) -> None:
+    POOL_STATS['requests'] += 1
+
+
+async def count_connection(session, context, params) -> None:
+    POOL_STATS['connections'] += 1
+
+
+async def count_reused(session, context, params) -> None:
+    POOL_STATS['reused'] += 1
+
+
+async def count_queued(session, context, params) -> None:
+    POOL_STATS['queued'] += 1
+
+
+def pool_stats() -> dict:
+    """Returns usage of the connection pool, queued is the number of requests that waited for a free connection"""
+    requests = POOL_STATS['requests']
+    return dict(POOL_STATS, pool_size=MAX_CONCURRENCY,
+                reuse_rate=POOL_STATS['reused'] / requests if requests else 0,
+                in_flight=MAX_CONCURRENCY - SEMAPHORE._value if SEMAPHORE else 0)
+
+
+async def start_client() -> None:
+    """Creates the shared http client and the semaphore inside the event loop"""
+    global CLIENT, SEMAPHORE
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(count_request)
+    trace.on_connection_create_end.append(count_connection)
+    trace.on_connection_reuseconn.append(count_reused)
+    trace.on_connection_queued_start.append(count_queued)
+    # cookies are sent with each request, the shared client must not keep them
+    CLIENT = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MAX_CONCURRENCY),
+                                   cookie_jar=aiohttp.DummyCookieJar(),
+                                   timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+                                   trace_configs=[trace])
+    SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENCY)
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Returns the event loop of the engine, starts it in a daemon thread on first call"""
+    global LOOP
+    with LOOP_LOCK:
+        if LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            asyncio.run_coroutine_threadsafe(start_client(), loop).result()
+            LOOP = loop
+    return LOOP
+
+
+def chat(query: str, dialog, token: str, lang: str, user_name: str, reset: bool = False, item: list = None) -> str:
+    """
+    Synchronous facade with the same arguments as my_bard.chat,
+    the calling thread waits while the request runs in the event loop.
+    """
+    if reset:
+        reset_bard_chat(dialog)
+        return
+    future = asyncio.run_coroutine_threadsafe(chat_async(query, dialog, token, lang, user_name, item), get_loop())
+    return future.result()
+
+
+def reset_bard_chat(dialog) -> None:
+    """Deletes the session of the dialog"""
+    my_bard.SESSIONS_DB.pop(dialog)
+    try:
+        del DIALOGS[dialog]
+    except KeyError:
+        pass
+
+
+def stub_answer(query: str) -> bytes:
+    """Builds a StreamGenerate answer in the bard format for the stub server,
+    with the service frames after the answer that bardapi expects"""
+    parsed_answer = [None, ['c_1', 'r_1'], [query], [], [['rc_1', [f'echo {query[:50]}']]]]
+    lines = [json.dumps([['wrb.fr', None, json.dumps(parsed_answer)]]),
+             json.dumps([['di', 100], ['af.httprm', 100, '0', 1]]),
+             json.dumps([['e', 4, None, None, 100]])]
+    return (")]}'\n\n" + ''.join(f'{len(line)}\n{line}\n' for line in lines)).encode('utf-8')
+
+
+async def stub_server(port: int, delay: float) -> asyncio.AbstractServer:
+    """Minimal keep-alive http server that answers like bard after a delay"""
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = re.search(rb'content-length: *(\d+)', head, re.IGNORECASE)
+                body = await reader.readexactly(int(length.group(1))) if length else b''
+                await asyncio.sleep(delay)
+                if head.startswith(b'GET'):
+                    answer = b'<script>{"SNlM0e":"stub"}</script>'
+                else:
+                    answer = stub_answer(body.decode()[:100])
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(answer) + answer)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+
+
+class StubAdapter(my_bard.SharedAdapter):
+    """Shared adapter of the thread engine that sends the requests of bardapi.Bard to the stub server"""
+    def __init__(self, pool_size: int, base_url: str):
+        super().__init__(pool_size)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        request.url = re.sub(r'^https://[^/]+', self.base_url, request.url)
+        return super().send(request, **kwargs)
+
+
+def benchmark(engine: str, dialogs: int, port: int = 18080, delay: float = 0.2, messages: int = 3) -> None:
+    """
+    Sends messages requests for each dialog concurrently through my_bard.chat to a local stub server
+    and prints throughput and peak memory, engine is the value of my_bard.ENGINE, 'thread' or 'async'.
+    Every dialog runs in its own thread like a bot handler does.
+    Run each engine in its own process to get clean memory numbers:
+        ./my_bard_async.py benchmark thread 1000
+        ./my_bard_async.py benchmark async 1000
+    """
+    import resource
+
+    global BASE_URL, MAX_CONCURRENCY
+    BASE_URL = f'http://127.0.0.1:{port}'
+    MAX_CONCURRENCY = dialogs
+    my_bard.ENGINE = engine
+    # bardapi.Bard has fixed urls, the shared adapter of its sessions redirects them to the stub server
+    my_bard.ADAPTER = StubAdapter(dialogs, BASE_URL)
+    # all dialogs at once, the queue of the bot is not measured here
+    my_bard.SCHEDULER = my_bard.Scheduler(dialogs, dialogs, my_bard.MAX_QUEUE_WAIT)
+    # do not touch saved sessions of real users
+    my_bard.SESSIONS_DB = {}
+    # both sides of every connection are in this process
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, min(hard, dialogs * 4 + 100)), hard))
+    server_loop = asyncio.new_event_loop()
+    server = server_loop.run_until_complete(stub_server(port, delay))
+    threading.Thread(target=server_loop.run_forever, daemon=True).start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    answers = []
+    def run_dialog(dialog):
+        for x in range(messages):
+            answers.append(my_bard.chat(f'message {x}', f'bench{dialog}', 'token', 'en', 'user'))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_dialog, args=(x,)) for x in range(dialogs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    failed = dialogs * messages - len([x for x in answers if x])
+    print(f'{engine:>6} engine, {dialogs:>5} dialogs: {dialogs * messages / elapsed:8.1f} requests/s, '
+          f'{elapsed:6.2f} s, peak memory +{(rss_after - rss_before) / 1024:.1f} MB, {failed} failed')
+    print(my_bard.pool_stats())
+    server_loop.call_soon_threadsafe(server.close)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) == 4 and sys.argv[1] == 'benchmark':
+        # my_bard.chat uses the imported module, not __main__
+        import my_bard_async
+        my_bard_async.benchmark(sys.argv[2], int(sys.argv[3]))
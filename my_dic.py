@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
 
+import atexit
+import contextlib
+import os
 import pickle
+import sqlite3
+import sys
 import threading
+import time
 from pprint import pprint
 
 import my_log
@@ -10,10 +16,50 @@ import my_log
 
 class PersistentDict(dict):
     """Словарь который хранит состояние в файле на диске, данные сохраняются между
-    перезапусками программы"""
-    def __init__(self, file_path):
+    перезапусками программы
+
+    In journal mode every change is appended to a log file (file_path + '.journal')
+    instead of rewriting the whole dict, the log is replayed on load and compacted
+    into the main pickle file in the background when it grows too big.
+
+    In write-behind mode changes only mark the dict as dirty, a background thread
+    writes one snapshot for many changes and the last snapshot is written on exit.
+
+    Snapshots are written to a temporary file and renamed, so a crash never leaves
+    a truncated file."""
+    def __init__(self, file_path, journal: bool = False, compact_size: int = 4 * 1024 * 1024,
+                 compact_ratio: float = 2.0, write_behind: bool = False, flush_interval: int = 1000,
+                 flush_every: int = 100, durability: str = 'file'):
+        """
+        Args:
+            file_path (str): path to the pickle file, old files are loaded as is.
+            journal (bool): append one record per change instead of full rewrite.
+            compact_size (int): compact the journal when it is bigger than this (bytes).
+            compact_ratio (float): compact the journal when it has more records than
+                                   compact_ratio * number of keys.
+            write_behind (bool): save snapshots from a background thread, ignored in journal mode.
+            flush_interval (int): write-behind, save dirty dict every flush_interval ms.
+            flush_every (int): write-behind, save at once after this number of changes.
+            durability (str): 'none' - do not fsync, 'file' - fsync the snapshot file,
+                              'full' - also fsync the directory after rename.
+        """
+        assert durability in ('none', 'file', 'full'), f'Unknown durability level: {durability}'
         self.lock = threading.Lock()
         self.file_path = file_path
+        self.journal = journal
+        self.journal_path = file_path + '.journal'
+        self.compact_size = compact_size
+        self.compact_ratio = compact_ratio
+        self.journal_file = None
+        self.journal_records = 0
+        self.compacting = False
+        self.write_behind = write_behind and not journal
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.durability = durability
+        self.dirty = 0
+        self.flush_lock = threading.Lock()
+        self.flush_event = threading.Event()
         try:
             with open(self.file_path, 'rb') as f:
                 try:
@@ -22,56 +68,351 @@ class PersistentDict(dict):
                     print(error, 'Empty message history')
                     my_log.log2(f'my_dic:init:{str(error)}')
                     data = []
-            self.update(data)
+            super().update(data)
+        except FileNotFoundError:
+            pass
+        if self.journal:
+            # the .old journal is left behind if the program stopped during compaction
+            old_records = self.replay(self.journal_path + '.old')
+            self.journal_records = self.replay(self.journal_path)
+            if old_records or os.path.exists(self.journal_path + '.old'):
+                self.compact(dict(self))
+            self.journal_file = open(self.journal_path, 'ab')
+        if self.write_behind:
+            thread = threading.Thread(target=self.flusher, daemon=True)
+            thread.start()
+            atexit.register(self.flush)
+
+    def replay(self, path: str) -> int:
+        """Applies records from the journal file to the dict, returns the number of records"""
+        count = 0
+        try:
+            with open(path, 'r+b') as f:
+                while True:
+                    position = f.tell()
+                    try:
+                        record = pickle.load(f)
+                    except EOFError:
+                        f.truncate(position)
+                        break
+                    except Exception as error:
+                        # the last record may be truncated if the program crashed while writing it,
+                        # cut it off so that new records are not appended after garbage
+                        my_log.log2(f'my_dic:replay:{path}:{str(error)}')
+                        f.truncate(position)
+                        break
+                    self.apply(record)
+                    count += 1
         except FileNotFoundError:
             pass
+        return count
+
+    def apply(self, record: tuple) -> None:
+        """Applies one journal record to the dict without saving it"""
+        if record[0] == 'set':
+            super().__setitem__(record[1], record[2])
+        elif record[0] == 'del':
+            super().pop(record[1], None)
+        elif record[0] == 'clear':
+            super().clear()
+
+    def save(self, records: list) -> None:
+        """Saves changes, must be called with the lock held.
+        Appends records to the journal, marks the dict as dirty or rewrites the whole file."""
+        if self.write_behind:
+            self.dirty += len(records)
+            if self.dirty >= self.flush_every:
+                self.flush_event.set()
+            return
+        if not self.journal:
+            self.write_snapshot(dict(self))
+            return
+        for record in records:
+            pickle.dump(record, self.journal_file)
+        self.journal_file.flush()
+        self.journal_records += len(records)
+        if self.compacting:
+            # previous compaction is still running or failed, keep appending
+            return
+        if (self.journal_file.tell() > self.compact_size or
+            self.journal_records > self.compact_ratio * max(len(self), 100)):
+            self.compacting = True
+            # rotate the journal now, write the snapshot in the background
+            self.journal_file.close()
+            os.replace(self.journal_path, self.journal_path + '.old')
+            self.journal_file = open(self.journal_path, 'ab')
+            self.journal_records = 0
+            thread = threading.Thread(target=self.compact, args=(dict(self),), daemon=True)
+            thread.start()
+
+    def write_snapshot(self, data: dict) -> None:
+        """Writes the data to a temporary file and atomically replaces the main file with it"""
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f)
+            if self.durability != 'none':
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        if self.durability == 'full' and hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.file_path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def flush(self) -> None:
+        """Write-behind, saves the dict if it has unsaved changes"""
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = dict(self)
+                self.dirty = 0
+            try:
+                self.write_snapshot(data)
+            except Exception as error:
+                my_log.log2(f'my_dic:flush:{str(error)}')
+                with self.lock:
+                    self.dirty += 1
+
+    def flusher(self) -> None:
+        """Write-behind background thread"""
+        while True:
+            self.flush_event.wait(self.flush_interval / 1000)
+            self.flush_event.clear()
+            self.flush()
+
+    def compact(self, data: dict) -> None:
+        """Writes a snapshot of the dict and removes the rotated journal.
+        If it fails the rotated journal is kept and no more compactions are started."""
+        self.compacting = True
+        try:
+            self.write_snapshot(data)
+            os.remove(self.journal_path + '.old')
+            self.compacting = False
+        except Exception as error:
+            my_log.log2(f'my_dic:compact:{str(error)}')
 
     def __setitem__(self, key, value):
-        super().__setitem__(key, value)
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            super().__setitem__(key, value)
+            self.save([('set', key, value)])
 
     def __delitem__(self, key):
-        super().__delitem__(key)
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            super().__delitem__(key)
+            self.save([('del', key)])
 
     def clear(self):
-        super().clear()
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            super().clear()
+            self.save([('clear',)])
 
     def pop(self, key, default=None):
-        value = super().pop(key, default)
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            value = super().pop(key, default)
+            self.save([('del', key)])
         return value
 
     def popitem(self):
-        item = super().popitem()
         with self.lock:
-            with open(self.file_path, 'rb') as f:
-                pickle.dump(dict(self), f)
+            item = super().popitem()
+            self.save([('del', item[0])])
         return item
 
     def setdefault(self, key, default=None):
-        value = super().setdefault(key, default)
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            value = super().setdefault(key, default)
+            self.save([('set', key, value)])
         return value
 
     def update(self, E=None, **F):
-        super().update(E, **F)
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            data = dict(E or {}, **F)
+            super().update(data)
+            self.save([('set', key, value) for key, value in data.items()])
+
+
+class SqliteDict:
+    """Same mapping interface as PersistentDict but the data is kept in a SQLite database,
+    only requested keys are read and only changed keys are written.
+    Keys and values are pickled, so any picklable objects can be used like in PersistentDict."""
+    def __init__(self, file_path):
+        self.lock = threading.Lock()
+        self.file_path = file_path
+        self.conn = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None,
+                                    cached_statements=32)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS kv (key BLOB PRIMARY KEY, value BLOB NOT NULL)')
+
+    def __contains__(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM kv WHERE key = ?', (pickle.dumps(key),)).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM kv WHERE key = ?', (pickle.dumps(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)',
+                              (pickle.dumps(key), pickle.dumps(value)))
+
+    def __delitem__(self, key):
+        with self.lock:
+            cursor = self.conn.execute('DELETE FROM kv WHERE key = ?', (pickle.dumps(key),))
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM kv').fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT key FROM kv').fetchall()
+        return [pickle.loads(x[0]) for x in rows]
+
+    def values(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT value FROM kv').fetchall()
+        return [pickle.loads(x[0]) for x in rows]
+
+    def items(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT key, value FROM kv').fetchall()
+        return [(pickle.loads(x[0]), pickle.loads(x[1])) for x in rows]
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM kv')
+
+    def pop(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM kv WHERE key = ?', (pickle.dumps(key),)).fetchone()
+            if row is None:
+                return default
+            self.conn.execute('DELETE FROM kv WHERE key = ?', (pickle.dumps(key),))
+        return pickle.loads(row[0])
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO kv (key, value) VALUES (?, ?)',
+                              (pickle.dumps(key), pickle.dumps(default)))
+            row = self.conn.execute('SELECT value FROM kv WHERE key = ?', (pickle.dumps(key),)).fetchone()
+        return pickle.loads(row[0])
+
+    def update(self, E=None, **F):
+        data = dict(E or {}, **F)
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)',
+                                      [(pickle.dumps(k), pickle.dumps(v)) for k, v in data.items()])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def migrate(pickle_path: str, sqlite_path: str) -> int:
+    """
+    Copies all data from a PersistentDict file (with its journal if any) to a SqliteDict database.
+    The data is written to a temporary database that replaces sqlite_path only when it is complete,
+    so an interrupted migration leaves no half-filled database behind and is done again next time.
+
+    Args:
+        pickle_path (str): The path to the PersistentDict pickle file.
+        sqlite_path (str): The path to the SQLite database, it is created if it does not exist.
+
+    Returns:
+        int: The number of migrated keys.
+    """
+    tmp_path = sqlite_path + '.migrating'
+    for path in (tmp_path, tmp_path + '-wal', tmp_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    if os.path.exists(sqlite_path):
+        # keys that are already in the database are kept, backup() also copies its wal
+        with contextlib.closing(sqlite3.connect(sqlite_path)) as existing, \
+             contextlib.closing(sqlite3.connect(tmp_path)) as copy:
+            existing.backup(copy)
+
+    journal = os.path.exists(pickle_path + '.journal') or os.path.exists(pickle_path + '.journal.old')
+    source = PersistentDict(pickle_path, journal=journal)
+    target = SqliteDict(tmp_path)
+    target.update(dict(source))
+    if source.journal_file:
+        source.journal_file.close()
+    target.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    target.close()
+
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    # the wal of the old database must not be applied to the new one
+    for path in (sqlite_path + '-wal', sqlite_path + '-shm', tmp_path + '-wal', tmp_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    os.replace(tmp_path, sqlite_path)
+    return len(source)
+
 
+def benchmark(sizes: tuple = (10_000, 100_000, 1_000_000), operations: int = 200) -> None:
+    """Compares load time, point reads and point writes of the storage engines"""
+    import tempfile
+    for size in sizes:
+        data = {x: ('en', f'token{x}') for x in range(size)}
+        with tempfile.TemporaryDirectory() as tmp:
+            pickle_path = os.path.join(tmp, 'db.pkl')
+            with open(pickle_path, 'wb') as f:
+                pickle.dump(data, f)
+            migrate(pickle_path, os.path.join(tmp, 'db.sqlite'))
+            engines = [('pickle', lambda: PersistentDict(pickle_path)),
+                       ('journal', lambda: PersistentDict(pickle_path, journal=True)),
+                       ('sqlite', lambda: SqliteDict(os.path.join(tmp, 'db.sqlite')))]
+            for name, engine in engines:
+                start = time.perf_counter()
+                db = engine()
+                load_time = time.perf_counter() - start
+                start = time.perf_counter()
+                for x in range(operations):
+                    db[x * 7 % size] = ('ru', 'token')
+                write_time = (time.perf_counter() - start) / operations
+                start = time.perf_counter()
+                for x in range(operations):
+                    _ = x * 13 % size in db and db[x * 13 % size]
+                read_time = (time.perf_counter() - start) / operations
+                print(f'{size:>9} keys {name:>8}: load {load_time * 1000:10.1f} ms, '
+                      f'write {write_time * 1000:8.3f} ms, read {read_time * 1000:8.4f} ms')
+                if isinstance(db, SqliteDict):
+                    db.close()
+                elif db.journal_file:
+                    db.journal_file.close()
 
 
 if __name__ == '__main__':
-    pass
+    # ./my_dic.py migrate db/db.pkl db/db.sqlite
+    # ./my_dic.py benchmark
+    if len(sys.argv) == 4 and sys.argv[1] == 'migrate':
+        print(migrate(sys.argv[2], sys.argv[3]), 'keys migrated')
+    elif len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark()
@@ -1,29 +1,130 @@
 #!/usr/bin/env python3
 
 
+import atexit
+import collections
 import os
 import datetime
+import queue
 import telebot
 import threading
-
-
-lock = threading.Lock()
+import time
 
 
 if not os.path.exists('logs'):
     os.mkdir('logs')
 
 
+# maximum number of log lines waiting to be written
+QUEUE_SIZE = 10000
+# what to do when the queue is full, 'drop' - lose the line, 'block' - wait until the writer catches up
+QUEUE_POLICY = 'drop'
+# maximum number of log files kept open, least recently used are closed first
+MAX_OPEN_FILES = 64
+# buffered lines are written at least this often, in seconds, or when this many bytes are buffered
+FLUSH_INTERVAL = 1
+FLUSH_BYTES = 64 * 1024
+
+
+class LogWriter(threading.Thread):
+    """Writes log lines in a background thread, callers only put lines to a bounded queue.
+    Lines are written in batches to files that are kept open."""
+    def __init__(self, queue_size: int, policy: str, max_open_files: int, flush_interval: float, flush_bytes: int):
+        super().__init__(name='my_log', daemon=True)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.policy = policy
+        self.max_open_files = max_open_files
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        # {path: file} in LRU order
+        self.files = collections.OrderedDict()
+        # {path: [text,...]} not written yet
+        self.buffers = collections.defaultdict(list)
+        self.buffered_bytes = 0
+        self.stats_counters = {'lines': 0, 'dropped': 0, 'batches': 0, 'errors': 0}
+        self.dropped_lock = threading.Lock()
+
+    def write(self, path: str, text: str) -> None:
+        """Puts the text to the queue of the file"""
+        if self.policy == 'block':
+            self.queue.put((path, text))
+            return
+        try:
+            self.queue.put_nowait((path, text))
+        except queue.Full:
+            with self.dropped_lock:
+                self.stats_counters['dropped'] += 1
+
+    def flush(self, timeout: float = 10) -> bool:
+        """Waits until everything queued before the call is written, returns False on timeout"""
+        if not self.is_alive():
+            return False
+        event = threading.Event()
+        self.queue.put((None, event))
+        return event.wait(timeout)
+
+    def open_file(self, path: str):
+        if path in self.files:
+            self.files.move_to_end(path)
+            return self.files[path]
+        while len(self.files) >= self.max_open_files:
+            self.files.popitem(last=False)[1].close()
+        self.files[path] = open(path, 'a', encoding="utf-8")
+        return self.files[path]
+
+    def write_buffers(self) -> None:
+        for path, texts in self.buffers.items():
+            try:
+                log_file = self.open_file(path)
+                log_file.write(''.join(texts))
+                log_file.flush()
+            except Exception as error:
+                self.stats_counters['errors'] += 1
+                print(f'my_log: {path}: {error}')
+                if path in self.files:
+                    self.files.pop(path).close()
+        self.buffers.clear()
+        self.buffered_bytes = 0
+        self.stats_counters['batches'] += 1
+
+    def run(self) -> None:
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                path, text = self.queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                path, text = None, None
+            if path is not None:
+                self.buffers[path].append(text)
+                self.buffered_bytes += len(text)
+                self.stats_counters['lines'] += 1
+            flush_event = text if path is None else None
+            if flush_event or self.buffered_bytes >= self.flush_bytes or time.time() >= deadline:
+                if self.buffers:
+                    self.write_buffers()
+                deadline = time.time() + self.flush_interval
+            if flush_event:
+                flush_event.set()
+
+    def stats(self) -> dict:
+        """Returns written, dropped lines, batches, queue length and number of open files"""
+        return dict(self.stats_counters, queued=self.queue.qsize(), open_files=len(self.files))
+
+
+WRITER = LogWriter(QUEUE_SIZE, QUEUE_POLICY, MAX_OPEN_FILES, FLUSH_INTERVAL, FLUSH_BYTES)
+WRITER.start()
+atexit.register(WRITER.flush)
+
+
 def log2(text: str) -> None:
     """для дебага"""
     time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
     log_file_path = 'logs/debug.log'
-    open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+    WRITER.write(log_file_path, f'{time_now}\n\n{text}\n{"=" * 80}\n')
 
 
 def log_echo(message: telebot.types.Message, reply_from_bot: str = '', debug: bool = False) -> None:
     """writes to the log a message received by the regular message handler or a bot response"""
-    global lock
     time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
     private_or_chat = 'private' if message.chat.type == 'private' else 'chat'
     chat_name = message.chat.username or message.chat.first_name or message.chat.title or ''
@@ -48,17 +149,14 @@ def log_echo(message: telebot.types.Message, reply_from_bot: str = '', debug: bo
     if topic_id:
         log_file_path = log_file_path[:-4] + f' [{topic_id}].log'
 
-    with lock:
-        with open(log_file_path, 'a', encoding="utf-8") as log_file:
-            if reply_from_bot:
-                log_file.write(f"[{time_now}] [BOT]: {reply_from_bot}\n")
-            else:
-                log_file.write(f"[{time_now}] [{user_name}]: {message.text or message.caption or ''}\n")
+    if reply_from_bot:
+        WRITER.write(log_file_path, f"[{time_now}] [BOT]: {reply_from_bot}\n")
+    else:
+        WRITER.write(log_file_path, f"[{time_now}] [{user_name}]: {message.text or message.caption or ''}\n")
 
 
 def log_media(message: telebot.types.Message) -> None:
     """log media files"""
-    global lock
     time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
     private_or_chat = 'private' if message.chat.type == 'private' else 'chat'
     chat_name = message.chat.username or message.chat.first_name or message.chat.title or ''
@@ -88,32 +186,24 @@ def log_media(message: telebot.types.Message) -> None:
         file_duration = message.audio.duration
         file_title = message.audio.title
         file_mime_type = message.audio.mime_type
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил аудио файл] [caption: {caption}] [title: {file_title}] \
+        WRITER.write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил аудио файл] [caption: {caption}] [title: {file_title}] \
 [filename: {file_name}] [filesize: {file_size}] [duration: {file_duration}] [mime type: {file_mime_type}]\n")
 
     if message.voice:
         file_size = message.voice.file_size
         file_duration = message.voice.duration
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил голосовое сообщение] [filesize: \
+        WRITER.write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил голосовое сообщение] [filesize: \
 {file_size}] [duration: {file_duration}]\n")
 
     if message.document:
         file_name = message.document.file_name
         file_size = message.document.file_size
         file_mime_type = message.document.mime_type
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил документ] [caption: {caption}] \
+        WRITER.write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил документ] [caption: {caption}] \
 [filename: {file_name}] [filesize: {file_size}] [mime type: {file_mime_type}]\n")
 
     if message.photo or message.video:
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил фото] [caption]: {caption}\n")
+        WRITER.write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил фото] [caption]: {caption}\n")
 
 
 if __name__ == '__main__':
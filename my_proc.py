@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Runs external tools (ffmpeg, trans, espeak-ng) with a global and per-tool limit of processes
+at the same time, a hard timeout and resource usage accounting.
+"""
+
+
+import collections
+import os
+import signal
+import subprocess
+import threading
+import time
+
+import my_log
+
+
+# maximum number of external processes at the same time
+MAX_PROCESSES = 8
+# maximum number of processes of one tool at the same time, tools not listed here get DEFAULT_TOOL_LIMIT
+TOOL_LIMITS = {'ffmpeg': 4, 'trans': 4, 'espeak-ng': 2}
+DEFAULT_TOOL_LIMIT = 4
+# timeout of a process in seconds if the caller did not set one, the process is killed after it
+DEFAULT_TIMEOUT = 60
+# how often the peak memory of a running process is read from /proc, in seconds
+RSS_SAMPLE_INTERVAL = 0.05
+
+GLOBAL_SEMAPHORE = threading.BoundedSemaphore(MAX_PROCESSES)
+# {tool: BoundedSemaphore}, created on first use
+TOOL_SEMAPHORES = {}
+STATS_LOCK = threading.Lock()
+# {tool: {counters}}
+STATS = {}
+# queue waits of the last runs {tool: deque}
+QUEUE_WAITS = collections.defaultdict(lambda: collections.deque(maxlen=1000))
+
+
+class Process(subprocess.Popen):
+    """Popen that collects cpu usage of the finished child with os.wait4"""
+    rusage = None
+
+    if hasattr(os, 'wait4'):
+        def _try_wait(self, wait_flags):
+            try:
+                (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+            except ChildProcessError:
+                pid = self.pid
+                sts = 0
+            else:
+                if pid == self.pid:
+                    self.rusage = rusage
+            return (pid, sts)
+
+
+def tool_semaphore(tool: str) -> threading.BoundedSemaphore:
+    with STATS_LOCK:
+        if tool not in TOOL_SEMAPHORES:
+            TOOL_SEMAPHORES[tool] = threading.BoundedSemaphore(TOOL_LIMITS.get(tool, DEFAULT_TOOL_LIMIT))
+        return TOOL_SEMAPHORES[tool]
+
+
+def peak_rss_kb(pid: int) -> int:
+    """Returns the peak resident memory of the process in kilobytes from /proc (linux), 0 if it is not available"""
+    try:
+        with open(f'/proc/{pid}/status', 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def write_input(stdin, input: bytes) -> None:
+    """Writes the input to stdin of the process and closes it, runs in its own thread"""
+    try:
+        if input:
+            stdin.write(input)
+    except OSError:
+        # the process exited or was killed without reading all the input
+        pass
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+def communicate(process: Process, input: bytes, timeout: float) -> tuple:
+    """
+    Process.communicate that reads the peak memory of the process while it runs.
+    ru_maxrss of wait4 is not used for it, on linux it keeps the memory the child inherited
+    from the bot at fork, so every small tool would report the size of the bot.
+    The input is written by a separate thread, Popen.communicate cannot continue sending
+    the input after it timed out, so it is only used to read the output in short slices.
+
+    Returns:
+        tuple: (stdout, stderr, peak rss in kilobytes), the peak is sampled every RSS_SAMPLE_INTERVAL
+            seconds, so it may miss a short spike, memory of child processes of the tool is not counted.
+
+    Raises:
+        subprocess.TimeoutExpired: After the timeout, the process is still running.
+    """
+    if process.stdin:
+        stdin, process.stdin = process.stdin, None
+        threading.Thread(target=write_input, args=(stdin, input), daemon=True).start()
+    deadline = time.perf_counter() + timeout
+    peak = peak_rss_kb(process.pid)
+    while True:
+        try:
+            stdout, stderr = process.communicate(timeout=min(RSS_SAMPLE_INTERVAL,
+                                                             max(0, deadline - time.perf_counter())))
+            return stdout, stderr, peak
+        except subprocess.TimeoutExpired:
+            peak = max(peak, peak_rss_kb(process.pid))
+            if time.perf_counter() >= deadline:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+
+
+def kill(process: Process) -> None:
+    """Kills the process with all its children, the process is the leader of its own session"""
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def record(tool: str, usage: dict, status: str) -> None:
+    """Adds the usage of one run to the stats of the tool, status is 'ok', 'failure' or 'timeout'"""
+    with STATS_LOCK:
+        stats = STATS.setdefault(tool, {'calls': 0, 'failures': 0, 'timeouts': 0, 'queue_wait': 0.0,
+                                        'max_queue_wait': 0.0, 'wall': 0.0, 'cpu': 0.0, 'max_rss_kb': 0})
+        stats['calls'] += 1
+        if status != 'ok':
+            stats[status + 's'] += 1
+        stats['queue_wait'] += usage['queue_wait']
+        stats['max_queue_wait'] = max(stats['max_queue_wait'], usage['queue_wait'])
+        stats['wall'] += usage['wall']
+        stats['cpu'] += usage['cpu_user'] + usage['cpu_system']
+        stats['max_rss_kb'] = max(stats['max_rss_kb'], usage['max_rss_kb'])
+        QUEUE_WAITS[tool].append(usage['queue_wait'])
+
+
+def run(args: list, input: bytes = None, timeout: float = DEFAULT_TIMEOUT, tool: str = None) -> subprocess.CompletedProcess:
+    """
+    Runs the command and waits for it like subprocess.run with stdout and stderr captured.
+    Waits in the queue if too many processes of this tool or at all are running.
+
+    Args:
+        args (list): The command and its arguments.
+        input (bytes): Data for stdin of the process.
+        timeout (float): The time in seconds after which the process and its children are killed.
+        tool (str): The name of the tool for the limits and the stats, the name of the command by default.
+
+    Returns:
+        subprocess.CompletedProcess: The result of the process with an additional attribute usage
+            {queue_wait, wall, cpu_user, cpu_system, max_rss_kb}, times in seconds,
+            max_rss_kb is sampled from /proc while the process runs, 0 where /proc is not available.
+
+    Raises:
+        subprocess.TimeoutExpired: If the process was killed after the timeout.
+        OSError: If the command could not be started.
+    """
+    tool = tool or os.path.basename(args[0])
+    usage = {'queue_wait': 0.0, 'wall': 0.0, 'cpu_user': 0.0, 'cpu_system': 0.0, 'max_rss_kb': 0}
+    status = 'failure'
+    process = None
+    start = time.perf_counter()
+    with tool_semaphore(tool), GLOBAL_SEMAPHORE:
+        usage['queue_wait'] = time.perf_counter() - start
+        start = time.perf_counter()
+        try:
+            process = Process(args, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+            with process:
+                try:
+                    stdout, stderr, usage['max_rss_kb'] = communicate(process, input, timeout)
+                except subprocess.TimeoutExpired:
+                    status = 'timeout'
+                    kill(process)
+                    process.communicate()
+                    my_log.log2(f'my_proc: {tool} killed after {timeout}s: {args[:3]}')
+                    raise
+                except:
+                    kill(process)
+                    raise
+            if process.returncode == 0:
+                status = 'ok'
+        finally:
+            usage['wall'] = time.perf_counter() - start
+            if process and process.rusage:
+                usage['cpu_user'] = process.rusage.ru_utime
+                usage['cpu_system'] = process.rusage.ru_stime
+            record(tool, usage, status)
+    result = subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+    result.usage = usage
+    return result
+
+
+def stats() -> dict:
+    """Returns counters, queue wait percentiles, total wall and cpu time and peak rss of every tool"""
+    with STATS_LOCK:
+        result = {}
+        for tool, counters in STATS.items():
+            waits = sorted(QUEUE_WAITS[tool])
+            result[tool] = dict(counters)
+            for key in ('queue_wait', 'max_queue_wait', 'wall', 'cpu'):
+                result[tool][key] = round(result[tool][key], 3)
+            if waits:
+                result[tool]['queue_wait_p50'] = round(waits[len(waits) // 2], 3)
+                result[tool]['queue_wait_p95'] = round(waits[int(len(waits) * 0.95)], 3)
+        return result
+
+
+if __name__ == '__main__':
+    print(run(['sleep', '0.1']).usage)
+    # the input must reach a process that runs longer than one sampling slice, also when it does not fit in the pipe
+    for data in (b'hello', b'x' * (1 << 20)):
+        assert run(['sh', '-c', f'sleep {RSS_SAMPLE_INTERVAL * 4}; cat'], input=data).stdout == data
+    try:
+        run(['sleep', '5'], timeout=0.5)
+    except subprocess.TimeoutExpired as error:
+        print(error)
+    print(stats())
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+User-facing strings of the bot and their precompiled translations.
+
+The translations are built offline with [./my_strings.py build] into a gzipped json bundle
+and loaded once at startup, the bot translates static strings at request time only for
+languages missing from the bundle.
+"""
+
+
+import gzip
+import json
+import os
+import sys
+import threading
+
+import my_log
+import my_trans
+
+
+# bundle with the translations of CATALOG, lives next to the module
+BUNDLE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ui_strings.json.gz')
+
+
+# languages supported by the translator and by the /trans command
+supported_langs_trans = [
+        "af","am","ar","az","be","bg","bn","bs","ca","ceb","co","cs","cy","da","de",
+        "el","en","eo","es","et","eu","fa","fi","fr","fy","ga","gd","gl","gu","ha",
+        "haw","he","hi","hmn","hr","ht","hu","hy","id","ig","is","it","iw","ja","jw",
+        "ka","kk","km","kn","ko","ku","ky","la","lb","lo","lt","lv","mg","mi","mk",
+        "ml","mn","mr","ms","mt","my","ne","nl","no","ny","or","pa","pl","ps","pt",
+        "ro","ru","rw","sd","si","sk","sl","sm","sn","so","sq","sr","st","su","sv",
+        "sw","ta","te","tg","th","tl","tr","uk","ur","uz","vi","xh","yi","yo","zh",
+        "zh-TW","zu"]
+
+
+HELP = r'''You need to get a google bard token to talk with Bard.
+
+1. Install Cookie-Editor extension.
+
+2. Go to https://bard.google.com and login, you may need to use a VPN to access Bard in countries where it is not available.
+
+3. Click on the extension icon and copy a token starting with [__Secure-1PSID]
+Ensure you are copying the correct token corresponding to the account number, which can be found in the URL as bard.google.com/u/{account_number}.
+If your account number is /u/2, search for the token named __Secure-2PSID.
+If your account number is /u/3, search for the token named __Secure-3PSID.
+Try new account if this fail.
+
+4. Paste the token in the bot as [/token xxx...xxx]. 
+
+You can set a token for group by coping the personal token, use [/token copy] command in chat.
+
+Other bots:
+chatGPT - @chat_GPT_free_007_bot
+all-in-one - @kun4sun_bot
+translator - @chats_translator_bot
+'''
+
+
+USER_NOT_FOUND = 'User not found.'
+
+NO_TEXT_RECOGNIZED = 'Did not recognize any text.'
+
+TTS_HELP = '@tts text to say with google voice'
+
+TTS_FAILED = 'TTS failed.'
+
+TTS_TOO_LONG = 'Text too long for TTS: {length} of {max_length}'
+
+TRANS_HELP = """@trans [en|ru|uk|..] text to be translated into the specified language
+
+If not specified, then your language will be used.
+
+@trans de hi, how are you?
+@trans was ist das
+
+Supported languages: """
+
+TRANS_FAILED = 'Ошибка перевода'
+
+NEW_DIALOG = 'New dialog started.'
+
+NEED_TOKEN = 'You have to provide a token. Use [/token] command.'
+
+NEED_TOKEN_GROUP = 'You have to provide a token. Use [/token copy] command to copy your private token.'
+
+BARD_BUSY = 'Too many requests to Bard right now, please try again later.'
+
+BARD_NO_ANSWER = 'Bard did not answer. May be you need to renew your token.'
+
+BARD_TOO_LONG = 'Message too long for bard: {length} of {max_length}'
+
+
+# all the static strings that are sent to users, add new ones here and rebuild the bundle
+CATALOG = [HELP, USER_NOT_FOUND, NO_TEXT_RECOGNIZED, TTS_HELP, TTS_FAILED, TTS_TOO_LONG, TRANS_HELP, TRANS_FAILED,
+           NEW_DIALOG, NEED_TOKEN, NEED_TOKEN_GROUP, BARD_BUSY, BARD_NO_ANSWER, BARD_TOO_LONG]
+
+
+# {lang: {text: translated text,...},...}, filled by load()
+BUNDLE = {}
+BUNDLE_LOCK = threading.Lock()
+
+
+def load(path: str = BUNDLE_PATH) -> dict:
+    """
+    Loads the bundle of precompiled translations into BUNDLE.
+    Strings that were changed after the bundle was built are skipped and translated live.
+
+    Args:
+        path (str): The path to the bundle file.
+
+    Returns:
+        dict: The loaded bundle {lang: {text: translated text,...},...}.
+    """
+    bundle = {}
+    if os.path.exists(path):
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+            catalog = data['catalog']
+            current = set(CATALOG)
+            for lang, translations in data['langs'].items():
+                bundle[lang] = {text: translated for text, translated in zip(catalog, translations)
+                                if text in current and translated}
+        except Exception as error:
+            my_log.log2(f'my_strings:load: {error}')
+            bundle = {}
+    with BUNDLE_LOCK:
+        BUNDLE.clear()
+        BUNDLE.update(bundle)
+    return bundle
+
+
+def build(path: str = BUNDLE_PATH, langs: list = None) -> None:
+    """
+    Translates CATALOG into every supported language and writes the bundle.
+    Translations that failed are saved as empty strings and will be translated live.
+
+    Args:
+        path (str): The path to the bundle file.
+        langs (list): The languages to translate into, supported_langs_trans by default.
+    """
+    langs = [lang for lang in (langs or supported_langs_trans) if lang != 'en']
+    translations = my_trans.translate_many(CATALOG, langs)
+    data = {'catalog': CATALOG,
+            'langs': {lang: [translations.get((text, lang)) or '' for text in CATALOG] for lang in langs}}
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    missing = sum(1 for lang in langs for translated in data['langs'][lang] if not translated)
+    print(f'{path}: {len(CATALOG)} strings, {len(langs)} languages, {missing} missing, {os.path.getsize(path)} bytes')
+
+
+def tr(text: str, lang: str, **kwargs) -> str:
+    """
+    Returns the text translated to the language, from the bundle if possible.
+
+    Args:
+        text (str): The text to be translated, usually one of CATALOG.
+        lang (str): The language to translate the text into.
+        kwargs: Values of the {placeholders} of the text, they are filled in after the translation.
+
+    Returns:
+        str: The translated text, or the text itself if the translation failed.
+    """
+    translated = text
+    if lang != 'en':
+        try:
+            translated = BUNDLE[lang][text]
+        except KeyError:
+            translated = my_trans.translate(text, lang) or text
+    if not kwargs:
+        return translated
+    try:
+        return translated.format(**kwargs)
+    except (KeyError, IndexError, ValueError):
+        # the translator changed the placeholders
+        return text.format(**kwargs)
+
+
+load()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'build':
+        build(langs=sys.argv[2:])
+    else:
+        print('Usage: ./my_strings.py build [lang ...]')
@@ -1,79 +1,366 @@
 #!/usr/bin/env python3
 
 
+import array
+import concurrent.futures
+import json
 import os
-import subprocess
-import tempfile
+import sqlite3
+import sys
+import threading
+import time
+
 import speech_recognition as sr
+try:
+    import vosk
+except ImportError:
+    vosk = None
 
+import my_backends
 import my_log
+import my_proc
+
+
+# folder for permanent dictionaries, bot memory
+if not os.path.exists('db'):
+    os.mkdir('db')
+
+
+# speech recognition input, ffmpeg decodes voice messages to raw pcm in this format
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+# timeout of one ffmpeg decoding in seconds
+FFMPEG_TIMEOUT = 60
+
+# free google recognition accepts less than 55 seconds, longer audio is split into segments up to this length
+MAX_SEGMENT_SECONDS = 50
+# a segment is cut at the quietest moment within this number of seconds before its maximum length
+SPLIT_SEARCH_SECONDS = 10
+# length of the frames compared when looking for silence, in seconds
+FRAME_SECONDS = 0.02
+# longer audio is not recognized
+MAX_AUDIO_SECONDS = 30 * 60
+# timeout of the recognition of one segment in seconds
+SEGMENT_TIMEOUT = 30
+# maximum number of segments recognized at the same time, for all users
+MAX_WORKERS = 6
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='my_stt')
 
+# backends are tried in this order, 'google' - free google speech recognition, 'vosk' - local vosk models
+BACKEND_ORDER = ['google', 'vosk']
+# paths to vosk models {lang: path}, https://alphacephei.com/vosk/models
+VOSK_MODELS = {}
+# loaded vosk models {lang: vosk.Model}, a model is loaded once and kept in memory
+VOSK_LOADED = {}
+VOSK_LOCK = threading.Lock()
 
-def convert_to_wave_with_ffmpeg(audio_file: str) -> str:
+# maximum number of transcripts kept on disk, least recently used are removed first
+TRANSCRIPTS_MAX = 50000
+
+
+def decode_to_pcm(audio: bytes) -> bytes:
     """
-    Converts an audio file to a wave format using FFmpeg.
+    Decodes audio to 16 kHz mono 16-bit pcm with one ffmpeg process, in and out through pipes.
 
     Args:
-        audio_file (str): The path to the audio file to be converted.
+        audio (bytes): The audio in any format ffmpeg understands.
 
     Returns:
-        str: The path to the converted wave file.
+        bytes: Raw little-endian pcm samples.
     """
-    with tempfile.NamedTemporaryFile() as temp_file:
-        tmp_wav_file = temp_file.name + '.wav'
-    subprocess.run(['ffmpeg', '-i', audio_file, tmp_wav_file], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return tmp_wav_file
+    result = my_proc.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0',
+                          '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(SAMPLE_RATE), 'pipe:1'],
+                         input=audio, timeout=FFMPEG_TIMEOUT)
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpeg: {result.stderr.decode("utf-8", errors="replace").strip()[-500:]}')
+    return result.stdout
+
+
+def pcm_duration(pcm: bytes) -> float:
+    """Returns the duration of the pcm from decode_to_pcm in seconds"""
+    return len(pcm) / (SAMPLE_RATE * SAMPLE_WIDTH)
+
 
+def frame_energy(frame: bytes) -> int:
+    """Returns the sum of absolute sample values of a piece of pcm"""
+    samples = array.array('h', frame)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return sum(map(abs, samples))
 
-def audio_duration(audio_file: str) -> int:
+
+def split_pcm(pcm: bytes, max_seconds: float = MAX_SEGMENT_SECONDS) -> list:
     """
-    Get the duration of an audio file.
+    Splits the pcm into segments up to max_seconds long. Every segment is cut at the quietest
+    frame of its last SPLIT_SEARCH_SECONDS so that words are not cut in the middle.
 
     Args:
-        audio_file (str): The path to the audio file.
+        pcm (bytes): The audio from decode_to_pcm.
+        max_seconds (float): The maximum length of a segment.
 
     Returns:
-        int: The duration of the audio file in seconds.
+        list: The segments of the pcm in order.
     """
-    result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', audio_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    return float(result.stdout)
+    bytes_per_second = SAMPLE_RATE * SAMPLE_WIDTH
+    max_bytes = int(max_seconds * bytes_per_second) // SAMPLE_WIDTH * SAMPLE_WIDTH
+    search_bytes = min(int(SPLIT_SEARCH_SECONDS * bytes_per_second), max_bytes // 2)
+    frame_bytes = int(FRAME_SECONDS * bytes_per_second) // SAMPLE_WIDTH * SAMPLE_WIDTH
+    view = memoryview(pcm)
+    segments = []
+    start = 0
+    while len(pcm) - start > max_bytes:
+        end = start + max_bytes
+        quietest = min(range(end - search_bytes, end - frame_bytes + 1, frame_bytes),
+                       key=lambda x: frame_energy(view[x:x + frame_bytes]))
+        cut = quietest + frame_bytes // 2 // SAMPLE_WIDTH * SAMPLE_WIDTH
+        segments.append(bytes(view[start:cut]))
+        start = cut
+    segments.append(bytes(view[start:]))
+    return segments
 
 
-def stt_google(audio_file: str, language: str) -> str:
+def stt_google(pcm: bytes, language: str) -> str:
     """
     Speech-to-text using Google's speech recognition API.
     
     Args:
-        audio_file (str): The path to the audio file to be transcribed.
+        pcm (bytes): The audio from decode_to_pcm.
         language (str, optional): The language of the audio file. Defaults to 'ru'.
     
     Returns:
         str: The transcribed text from the audio file.
     """
-    assert audio_duration(audio_file) < 55, 'Too big for free speech recognition'
-    audio_file2 = convert_to_wave_with_ffmpeg(audio_file)
+    assert pcm_duration(pcm) < 55, 'Too big for free speech recognition'
     google_recognizer = sr.Recognizer()
-
-    with sr.AudioFile(audio_file2) as source:
-        audio = google_recognizer.record(source)  # read the entire audio file
+    google_recognizer.operation_timeout = SEGMENT_TIMEOUT
+    audio = sr.AudioData(pcm, SAMPLE_RATE, SAMPLE_WIDTH)
 
     text = google_recognizer.recognize_google(audio, language=language)
 
-    os.remove(audio_file2)
-
     return text
 
 
-def stt(input_file: str, lang: str) -> str:
+def recognize_segment(pcm: bytes, language: str) -> str:
+    """Recognizes one segment of a long audio, a segment without speech gives an empty string"""
+    try:
+        return stt_google(pcm, language)
+    except sr.UnknownValueError:
+        return ''
+
+
+def stt_long(pcm: bytes, language: str) -> tuple:
+    """
+    Speech-to-text of audio of any length. The audio is split at silence into segments that are
+    recognized in parallel, the transcripts are joined in order. A segment that failed or did not
+    finish in SEGMENT_TIMEOUT is skipped, if all of them failed the last error is raised.
+
+    Args:
+        pcm (bytes): The audio from decode_to_pcm.
+        language (str): The language of the audio.
+
+    Returns:
+        tuple: (the transcribed text, whether all the segments were recognized).
+    """
+    segments = split_pcm(pcm)
+    if len(segments) == 1:
+        return recognize_segment(pcm, language), True
+    futures = [EXECUTOR.submit(recognize_segment, segment, language) for segment in segments]
+    # recognizer.operation_timeout limits every request, this is a safety net for a stuck segment,
+    # segments that wait in the pool queue behind others get more time
+    texts = []
+    last_error = None
+    for number, future in enumerate(futures):
+        try:
+            texts.append(future.result(timeout=SEGMENT_TIMEOUT * (1 + number // MAX_WORKERS)))
+        except Exception as error:
+            future.cancel()
+            last_error = error
+            my_log.log2(f'my_stt:stt_long: segment {number + 1} of {len(segments)}: {error!r}')
+    if not texts:
+        raise last_error
+    return ' '.join(text.strip() for text in texts if text and text.strip()), len(texts) == len(segments)
+
+
+def vosk_model(lang: str):
+    """Returns the vosk model for the language, loads it on first use"""
+    with VOSK_LOCK:
+        if lang not in VOSK_LOADED:
+            start = time.perf_counter()
+            VOSK_LOADED[lang] = vosk.Model(VOSK_MODELS[lang])
+            my_log.log2(f'my_stt: vosk model {VOSK_MODELS[lang]} loaded in {time.perf_counter() - start:.1f}s')
+        return VOSK_LOADED[lang]
+
+
+def preload() -> None:
+    """Loads the vosk models of VOSK_MODELS if vosk is used, so that the first voice message does not wait for it"""
+    if vosk is None or 'vosk' not in BACKEND_ORDER:
+        return
+    vosk.SetLogLevel(-1)
+    for lang in VOSK_MODELS:
+        try:
+            vosk_model(lang)
+        except Exception as error:
+            my_log.log2(f'my_stt:preload: {lang}: {error}')
+
+
+def stt_vosk(pcm: bytes, language: str) -> tuple:
     """
-    Generate the function comment for the given function body in a markdown code block with the correct language syntax.
+    Offline speech-to-text with a vosk model, audio of any length.
 
     Args:
-        input_file (str): The input file to be processed.
-        lang (str): The language of the input file.
+        pcm (bytes): The audio from decode_to_pcm.
+        language (str): The language of the audio, a key of VOSK_MODELS.
+
+    Returns:
+        tuple: (the transcribed text, True).
+    """
+    recognizer = vosk.KaldiRecognizer(vosk_model(language), SAMPLE_RATE)
+    texts = []
+    step = SAMPLE_RATE * SAMPLE_WIDTH // 2
+    for start in range(0, len(pcm), step):
+        if recognizer.AcceptWaveform(pcm[start:start + step]):
+            texts.append(json.loads(recognizer.Result()).get('text', ''))
+    texts.append(json.loads(recognizer.FinalResult()).get('text', ''))
+    return ' '.join(text for text in texts if text), True
+
+
+# registered backends, see my_backends
+BACKENDS = my_backends.Registry('my_stt')
+
+
+def register_backend(name: str, function, supports, timeout: float, max_rtf: float, workers: int = 8) -> None:
+    """
+    Registers a speech recognition backend, add its name to BACKEND_ORDER to use it.
+
+    Args:
+        name (str): The name of the backend.
+        function: function(pcm, lang) -> (text, complete), recognizes the pcm from decode_to_pcm,
+            complete is False if a part of the audio was not recognized.
+        supports: function(lang) -> bool, whether the backend can recognize the language now.
+        timeout (float), max_rtf (float): the next backend is tried after
+            timeout + audio duration * max_rtf seconds.
+        workers (int): The maximum number of calls of the backend at the same time.
+    """
+    BACKENDS.register(name, function, timeout, workers, max_rtf, supports)
+
+
+def backend_stats() -> dict:
+    """Returns stats of all registered backends {name: {calls, failures, timeouts, busy, healthy, latency_*, rtf_*,...}}"""
+    return BACKENDS.stats()
+
+
+register_backend('google', stt_long, lambda lang: True, timeout=15, max_rtf=0.3, workers=8)
+# vosk is cpu bound, more recognitions at the same time only make each of them slower
+register_backend('vosk', stt_vosk, lambda lang: vosk is not None and lang in VOSK_MODELS, timeout=10, max_rtf=2,
+                 workers=max(1, (os.cpu_count() or 2) // 2))
+
+
+def recognize(pcm: bytes, lang: str) -> tuple:
+    """
+    Recognizes the pcm with the first backend of BACKEND_ORDER that supports the language and answers in time.
+
+    Args:
+        pcm (bytes): The audio from decode_to_pcm.
+        lang (str): The language of the audio.
+
+    Returns:
+        tuple: (the transcribed text, False if a part of the audio was not recognized).
+
+    Raises:
+        RuntimeError: If all backends failed.
+    """
+    result, backend = BACKENDS.run(BACKEND_ORDER, lang, pcm, lang, duration=pcm_duration(pcm))
+    if result is None:
+        raise RuntimeError(f'all speech recognition backends failed: {BACKEND_ORDER}')
+    return result
+
+
+class TranscriptCache:
+    """SQLite cache of transcripts keyed by (telegram file_unique_id, lang), so that a forwarded or
+    re-sent voice message is not downloaded, decoded and recognized again"""
+    def __init__(self, db_path: str, max_entries: int):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.inserts = 0
+        self.stats_counters = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'seconds_saved': 0.0}
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS transcripts (file_id TEXT NOT NULL, lang TEXT NOT NULL, '
+                          'text TEXT NOT NULL, size INTEGER NOT NULL, seconds REAL NOT NULL, used REAL NOT NULL, '
+                          'PRIMARY KEY (file_id, lang))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS transcripts_used ON transcripts (used)')
+
+    def get(self, file_id: str, lang: str) -> str:
+        """Returns the cached transcript or None"""
+        with self.lock:
+            row = self.conn.execute('SELECT text, size, seconds FROM transcripts WHERE file_id = ? AND lang = ?',
+                                    (file_id, lang)).fetchone()
+            if not row:
+                self.stats_counters['misses'] += 1
+                return None
+            self.conn.execute('UPDATE transcripts SET used = ? WHERE file_id = ? AND lang = ?',
+                              (time.time(), file_id, lang))
+            self.stats_counters['hits'] += 1
+            self.stats_counters['bytes_saved'] += row[1]
+            self.stats_counters['seconds_saved'] += row[2]
+            return row[0]
+
+    def put(self, file_id: str, lang: str, text: str, size: int, seconds: float) -> None:
+        """
+        Saves the transcript.
+
+        Args:
+            file_id (str): The telegram file_unique_id of the media.
+            lang (str): The language of the recognition.
+            text (str): The transcript.
+            size (int): The size of the downloaded file in bytes.
+            seconds (float): The time spent on downloading, decoding and recognition.
+        """
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO transcripts (file_id, lang, text, size, seconds, used) '
+                              'VALUES (?, ?, ?, ?, ?, ?)', (file_id, lang, text, size, seconds, time.time()))
+            self.inserts += 1
+            if self.inserts % 100 == 0:
+                count = self.conn.execute('SELECT COUNT(*) FROM transcripts').fetchone()[0]
+                if count > self.max_entries:
+                    self.conn.execute('DELETE FROM transcripts WHERE rowid IN '
+                                      '(SELECT rowid FROM transcripts ORDER BY used LIMIT ?)', (count - self.max_entries,))
+
+    def stats(self) -> dict:
+        """Returns hits, misses and the download bytes and processing seconds saved by hits"""
+        with self.lock:
+            return dict(self.stats_counters, seconds_saved=round(self.stats_counters['seconds_saved'], 1))
+
+
+TRANSCRIPTS = TranscriptCache('db/transcripts.sqlite', TRANSCRIPTS_MAX)
+
+
+def stt(audio: bytes, lang: str) -> str:
+    """
+    Speech-to-text of a voice message.
+
+    Args:
+        audio (bytes): The voice message as downloaded, in any format ffmpeg understands.
+        lang (str): The language of the voice message.
 
     Returns:
         str: The text generated from the input file.
+    """
+    return transcribe(audio, lang)[0]
+
+
+def transcribe(audio: bytes, lang: str) -> tuple:
+    """
+    Speech-to-text of a voice message that also tells whether the transcript is complete.
+
+    Args:
+        audio (bytes): The voice message as downloaded, in any format ffmpeg understands.
+        lang (str): The language of the voice message.
+
+    Returns:
+        tuple: (the text generated from the input file, False if the recognition failed for the whole
+            audio or a part of it).
 
     Raises:
         AssertionError: If an assertion error occurs during the execution.
@@ -81,10 +368,12 @@ def stt(input_file: str, lang: str) -> str:
         sr.RequestError: If a request error occurs during the execution.
         Exception: If any other unknown error occurs during the execution.
     """
-    text = ''
+    text, complete = '', False
 
     try:
-       text = stt_google(input_file, lang)
+       pcm = decode_to_pcm(audio)
+       assert pcm_duration(pcm) < MAX_AUDIO_SECONDS, 'Too big for speech recognition'
+       text, complete = recognize(pcm, lang)
     except AssertionError:
         pass
     except sr.UnknownValueError as unknown_value_error:
@@ -97,8 +386,45 @@ def stt(input_file: str, lang: str) -> str:
         print(unknown_error)
         my_log.log2(str(unknown_error))
 
-    return text
+    return text, complete
+
+
+def benchmark(delay: float = 0.5, per_second: float = 0.05) -> None:
+    """
+    Measures wall-clock time of sequential and parallel recognition of synthetic speech-like audio
+    of different lengths. Google is replaced by a stub that answers after delay + per_second * duration.
+    """
+    import math
+
+    def fake_recognize_google(self, audio, language='en-US', **kwargs):
+        time.sleep(delay + per_second * len(audio.frame_data) / (audio.sample_rate * audio.sample_width))
+        return 'words'
+    sr.Recognizer.recognize_google = fake_recognize_google
+
+    # 2.3 seconds of tone followed by 0.4 seconds of silence
+    word = array.array('h', (int(8000 * math.sin(2 * math.pi * 220 * x / SAMPLE_RATE))
+                             for x in range(int(2.3 * SAMPLE_RATE))))
+    word.extend([0] * int(0.4 * SAMPLE_RATE))
+    if sys.byteorder == 'big':
+        word.byteswap()
+    word = word.tobytes()
+
+    for seconds in (30, 60, 120, 300, 600):
+        pcm = (word * int(seconds / pcm_duration(word) + 1))[:seconds * SAMPLE_RATE * SAMPLE_WIDTH]
+        start = time.perf_counter()
+        segments = split_pcm(pcm)
+        split_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for segment in segments:
+            recognize_segment(segment, 'en')
+        sequential = time.perf_counter() - start
+        start = time.perf_counter()
+        stt_long(pcm, 'en')
+        parallel = time.perf_counter() - start
+        print(f'{seconds:4} s audio, {len(segments):2} segments: split {split_time:5.2f} s, '
+              f'sequential {sequential:6.2f} s, parallel {parallel:6.2f} s')
 
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark()
\ No newline at end of file
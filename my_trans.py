@@ -1,15 +1,173 @@
 #!/usr/bin/env python3
 
 
+import atexit
+import collections
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
 import subprocess
+import sys
+import threading
+import time
 
+import requests
+import requests.adapters
 from py_trans import PyTranslator
 
+import my_log
+import my_proc
 import utils
 
 
-# don't translate same text twice (text, lang):translated
-cached = {}
+# folder for permanent dictionaries, bot memory
+if not os.path.exists('db'):
+    os.mkdir('db')
+
+
+# memory budget of the translation cache in bytes, least recently used translations are removed first
+CACHE_MAX_BYTES = 10 * 1024 * 1024
+# translations older than this number of seconds are translated again, 0 - never
+CACHE_TTL = 0
+# maximum number of translations kept on disk, least recently used are removed first
+CACHE_MAX_DISK = 100000
+# number of most used translations that are loaded to memory at start
+CACHE_WARM = 1000
+
+# 'http' - in-process client (falls back to the next backend if it fails),
+# 'trans' - translate-shell utility, 'py_trans' - py_trans library (always used on windows)
+BACKEND = 'http'
+# google translate endpoint of the http backend, can be changed to a local stub server for tests
+TRANSLATE_URL = 'https://translate.googleapis.com/translate_a/single'
+# timeout of one translation request in seconds, (connect, read)
+TIMEOUT = (5, 20)
+# timeout of the trans utility in seconds, it is killed after that
+TRANS_TIMEOUT = 30
+
+# long-lived http client of the http backend, keeps connections open between translations
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=20))
+SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=20))
+# py_trans translator is created once
+PY_TRANSLATOR = None
+
+# maximum number of translations at the same time in translate_many
+MAX_WORKERS = 8
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='my_trans')
+
+# translations in progress {(text, lang): Future}, concurrent callers of the same key wait for one translation
+IN_FLIGHT = {}
+IN_FLIGHT_LOCK = threading.Lock()
+# 'calls' - translations done by a backend, 'suppressed' - duplicate calls that waited for them
+IN_FLIGHT_STATS = {'calls': 0, 'suppressed': 0}
+
+
+class TranslationCache:
+    """Two-tier cache of translations, a size-bounded LRU in memory and a SQLite table on disk
+    keyed by a hash of (text, lang). Most used translations are loaded to memory at start."""
+    def __init__(self, db_path: str, max_bytes: int, ttl: int, max_disk: int, warm: int):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_disk = max_disk
+        # {key: (translated, created, size)}
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        # hits of memory entries that are not saved to disk yet {key: hits}
+        self.pending_hits = collections.Counter()
+        self.inserts = 0
+        self.stats_counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translated TEXT NOT NULL, '
+                          'created REAL NOT NULL, used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS translations_used ON translations (used)')
+        rows = self.conn.execute('SELECT key, translated, created FROM translations ORDER BY hits DESC LIMIT ?',
+                                 (warm,)).fetchall()
+        with self.lock:
+            for key, translated, created in reversed(rows):
+                if not self.expired(created):
+                    self.memory_put(key, translated, created)
+
+    @staticmethod
+    def make_key(text: str, lang: str) -> str:
+        return hashlib.sha256(f'{lang}\0{text}'.encode('utf-8')).hexdigest()
+
+    def expired(self, created: float) -> bool:
+        return bool(self.ttl) and time.time() - created > self.ttl
+
+    def memory_put(self, key: str, translated: str, created: float) -> None:
+        """Adds the translation to memory and removes old ones, must be called with the lock held"""
+        size = len(key) + len(translated.encode('utf-8'))
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[2]
+        self.memory[key] = (translated, created, size)
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_bytes and self.memory:
+            old_key, old_item = self.memory.popitem(last=False)
+            self.memory_bytes -= old_item[2]
+            self.stats_counters['evictions'] += 1
+
+    def save_hits(self) -> None:
+        """Writes hit counters and last use time of memory hits to disk, must be called with the lock held"""
+        now = time.time()
+        self.conn.executemany('UPDATE translations SET hits = hits + ?, used = ? WHERE key = ?',
+                              [(hits, now, key) for key, hits in self.pending_hits.items()])
+        self.pending_hits.clear()
+
+    def flush(self) -> None:
+        """Writes pending hit counters to disk, called at exit"""
+        with self.lock:
+            self.save_hits()
+
+    def get(self, text: str, lang: str) -> str:
+        """Returns the cached translation or None"""
+        key = self.make_key(text, lang)
+        with self.lock:
+            item = self.memory.get(key)
+            if item and not self.expired(item[1]):
+                self.memory.move_to_end(key)
+                self.stats_counters['memory_hits'] += 1
+                self.pending_hits[key] += 1
+                if len(self.pending_hits) >= 100:
+                    self.save_hits()
+                return item[0]
+            row = self.conn.execute('SELECT translated, created FROM translations WHERE key = ?', (key,)).fetchone()
+            if row and not self.expired(row[1]):
+                self.conn.execute('UPDATE translations SET hits = hits + 1, used = ? WHERE key = ?', (time.time(), key))
+                self.memory_put(key, row[0], row[1])
+                self.stats_counters['disk_hits'] += 1
+                return row[0]
+            self.stats_counters['misses'] += 1
+            return None
+
+    def put(self, text: str, lang: str, translated: str) -> None:
+        """Saves the translation to memory and disk"""
+        key = self.make_key(text, lang)
+        now = time.time()
+        with self.lock:
+            self.memory_put(key, translated, now)
+            self.conn.execute('INSERT OR REPLACE INTO translations (key, translated, created, used, hits) '
+                              'VALUES (?, ?, ?, ?, 0)', (key, translated, now, now))
+            self.inserts += 1
+            if self.inserts % 1000 == 0:
+                count = self.conn.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+                if count > self.max_disk:
+                    self.conn.execute('DELETE FROM translations WHERE key IN '
+                                      '(SELECT key FROM translations ORDER BY used LIMIT ?)', (count - self.max_disk,))
+                    self.stats_counters['disk_evictions'] += count - self.max_disk
+
+    def stats(self) -> dict:
+        """Returns hit/miss/eviction counters and memory usage"""
+        with self.lock:
+            return dict(self.stats_counters, memory_entries=len(self.memory), memory_bytes=self.memory_bytes)
+
+
+# don't translate same text twice
+CACHE = TranslationCache('db/translations.sqlite', CACHE_MAX_BYTES, CACHE_TTL, CACHE_MAX_DISK, CACHE_WARM)
+atexit.register(CACHE.flush)
 
 
 def translate_text(text, lang):
@@ -21,14 +179,16 @@ def translate_text(text, lang):
         lang (str, optional): The language to translate the text to.
 
     Returns:
-        str or None: The translated text if the translation was successful, otherwise same text.
+        str: The translated text if the translation was successful, otherwise an empty string.
     """
-    x = PyTranslator()
-    r = x.translate(text, lang)
+    global PY_TRANSLATOR
+    if PY_TRANSLATOR is None:
+        PY_TRANSLATOR = PyTranslator()
+    r = PY_TRANSLATOR.translate(text, lang)
     if r['status'] == 'success':
         return r['translation']
-    return text
-    
+    return ''
+
 
 def translate_text2(text, lang):
     """
@@ -39,14 +199,37 @@ def translate_text2(text, lang):
         lang (str, optional): The language to translate the text to.
 
     Returns:
-        str or None: The translated text if the translation was successful, otherwise same text.
+        str: The translated text if the translation was successful, otherwise an empty string.
+    """
+    try:
+        result = my_proc.run(['trans', f':{lang}', '-b', text], timeout=TRANS_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as error:
+        my_log.log2(f'my_trans:translate_text2: {error}')
+        return ''
+    if result.returncode != 0:
+        my_log.log2(f'my_trans:translate_text2: {result.stderr.decode("utf-8", errors="replace").strip()[-500:]}')
+        return ''
+    return result.stdout.decode('utf-8').strip()
+
+
+def translate_text3(text, lang):
+    """
+    Translates the given text using the specified language. Using in-process http client.
+
+    Args:
+        text (str): The text to be translated.
+        lang (str, optional): The language to translate the text to.
+
+    Returns:
+        str: The translated text.
+
+    Raises:
+        requests.RequestException: If the request failed or timed out.
     """
-    process = subprocess.Popen(['trans', f':{lang}', '-b', text], stdout = subprocess.PIPE)
-    output, error = process.communicate()
-    r = output.decode('utf-8').strip()
-    if error != None:
-        return text
-    return r
+    params = {'client': 'gtx', 'sl': 'auto', 'tl': lang, 'dt': 't'}
+    response = SESSION.post(TRANSLATE_URL, params=params, data={'q': text}, timeout=TIMEOUT)
+    response.raise_for_status()
+    return ''.join(x[0] for x in response.json()[0] if x[0])
 
 
 def translate(text, lang):
@@ -58,22 +241,168 @@ def translate(text, lang):
         lang (str): The language to translate the text into.
 
     Returns:
-        str: The translated text.
+        str: The translated text or an empty string if the translation failed.
     """
-    if (text, lang) in cached:
-        return cached[(text, lang)]
-    
-    if 'windows' in utils.platform().lower():
-        translated = translate_text(text, lang)
-    else:
-        translated =  translate_text2(text, lang)
+    translated = CACHE.get(text, lang)
+    if translated is not None:
+        return translated
+    return translate_uncached(text, lang)
+
+
+def translate_uncached(text, lang):
+    """
+    Translates the text with the selected backend and saves the result to the cache.
+    If the same text is being translated to the same language by another thread,
+    waits for that translation instead of starting a new one.
+    """
+    key = (text, lang)
+    with IN_FLIGHT_LOCK:
+        future = IN_FLIGHT.get(key)
+        leader = future is None
+        if not leader:
+            IN_FLIGHT_STATS['suppressed'] += 1
+        else:
+            future = IN_FLIGHT[key] = concurrent.futures.Future()
+            IN_FLIGHT_STATS['calls'] += 1
+    if not leader:
+        return future.result()
+
+    try:
+        translated = translate_backend(text, lang)
+        future.set_result(translated)
+        return translated
+    except BaseException as error:
+        future.set_exception(error)
+        raise
+    finally:
+        with IN_FLIGHT_LOCK:
+            del IN_FLIGHT[key]
+
+
+def in_flight_stats() -> dict:
+    """Returns the number of backend translations and of duplicate calls that waited for them"""
+    with IN_FLIGHT_LOCK:
+        return dict(IN_FLIGHT_STATS, in_flight=len(IN_FLIGHT))
 
-    cached[(text, lang)] = translated
+
+def translate_backend(text, lang):
+    """Translates the text with the selected backend and saves the result to the cache, returns '' if it failed"""
+    translated = ''
+    if BACKEND == 'http':
+        try:
+            translated = translate_text3(text, lang)
+        except Exception as error:
+            my_log.log2(f'my_trans:translate: {error}')
+
+    if not translated:
+        try:
+            if 'windows' in utils.platform().lower() or BACKEND == 'py_trans':
+                translated = translate_text(text, lang)
+            else:
+                translated =  translate_text2(text, lang)
+        except Exception as error:
+            my_log.log2(f'my_trans:translate: {error}')
+
+    # failed translations are not cached, they are tried again next time
+    if translated:
+        CACHE.put(text, lang, translated)
     return translated
 
 
+def translate_many(texts, langs) -> dict:
+    """
+    Translates one or many texts to one or many languages at once. Duplicates are translated once,
+    cached translations are returned at once, the rest are translated in parallel by a bounded pool.
+
+    Args:
+        texts (str or list): The text or texts to be translated.
+        langs (str or list): The language or languages to translate the texts into.
+
+    Returns:
+        dict: {(text, lang): translated text,...} for every text and language, '' if the translation failed.
+    """
+    texts = [texts] if isinstance(texts, str) else texts
+    langs = [langs] if isinstance(langs, str) else langs
+    result = {}
+    misses = []
+    for text in dict.fromkeys(texts):
+        for lang in dict.fromkeys(langs):
+            translated = CACHE.get(text, lang)
+            if translated is None:
+                misses.append((text, lang))
+            else:
+                result[(text, lang)] = translated
+    futures = {EXECUTOR.submit(translate_uncached, text, lang): (text, lang) for text, lang in misses}
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            result[futures[future]] = future.result()
+        except Exception as error:
+            my_log.log2(f'my_trans:translate_many: {error}')
+            result[futures[future]] = ''
+    return result
+
+
+def benchmark(calls: int = 50, port: int = 18095) -> None:
+    """
+    Measures latency of one uncached translation for the http and trans backends against
+    a local stub server. The trans backend runs a stub 'trans' script so it pays the same
+    process start, interpreter start and new connection as translate-shell.
+    """
+    import http.server
+    import json
+    import tempfile
+    import urllib.parse
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length'] or 0)).decode('utf-8')
+            text = urllib.parse.parse_qs(body).get('q', [''])[0]
+            answer = json.dumps([[[f'[translated] {text}', text, None, None]], None, 'en']).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(answer)))
+            self.end_headers()
+            self.wfile.write(answer)
+
+        def log_message(self, *args):
+            pass
+
+    global TRANSLATE_URL
+    TRANSLATE_URL = f'http://127.0.0.1:{port}/translate_a/single'
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'trans'), 'w') as f:
+            f.write(f'''#!{sys.executable}
+import sys, urllib.request, urllib.parse, json
+data = urllib.parse.urlencode({{'q': sys.argv[-1]}}).encode()
+r = urllib.request.urlopen('{TRANSLATE_URL}?client=gtx&sl=auto&tl=' + sys.argv[1][1:] + '&dt=t', data)
+print(''.join(x[0] for x in json.load(r)[0]))
+''')
+        os.chmod(os.path.join(tmp, 'trans'), 0o755)
+        os.environ['PATH'] = tmp + os.pathsep + os.environ['PATH']
+
+        for name, function in (('http', translate_text3), ('trans', translate_text2)):
+            latencies = []
+            for x in range(calls):
+                start = time.perf_counter()
+                function(f'hello world {x}', 'ru')
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            print(f'{name:>6}: avg {sum(latencies) / calls * 1000:7.2f} ms, '
+                  f'p50 {latencies[calls // 2] * 1000:7.2f} ms, p95 {latencies[int(calls * 0.95)] * 1000:7.2f} ms')
+    server.shutdown()
+
+
 if __name__ == "__main__":
-    text = "Вітаю! Я - інфармацыйная сістэма, якая можа адказаць на запытанні ў вас."
-    
-    print(translate(text, 'en'))
-    print(translate(text, 'en'))
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark()
+    else:
+        text = "Вітаю! Я - інфармацыйная сістэма, якая можа адказаць на запытанні ў вас."
+
+        print(translate(text, 'en'))
+        print(translate(text, 'en'))
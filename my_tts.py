@@ -1,13 +1,55 @@
 #!/usr/bin/env python3
 
 
+import collections
+import concurrent.futures
+import hashlib
 import io
 import glob
 import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import unicodedata
 
 import gtts
 
+import my_backends
 import my_log
+import my_proc
+
+
+# folder for permanent dictionaries, bot memory
+if not os.path.exists('db'):
+    os.mkdir('db')
+
+
+# folder with synthesized voice messages in ogg/opus, one file per (text, lang)
+CACHE_DIR = 'db/tts_cache'
+# disk budget of the cache in bytes, least recently used files are removed first
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+# bitrate of the opus voice messages, telegram clients record voice at 32k
+OPUS_BITRATE = '32k'
+# timeout of one ffmpeg transcoding in seconds
+FFMPEG_TIMEOUT = 60
+
+# maximum length of the text for /tts
+MAX_TEXT_LEN = 5000
+# long texts are split at sentence boundaries into chunks up to this length (gTTS sends up to 100
+# characters in one request) that are synthesized in parallel
+CHUNK_LEN = 100
+# maximum number of chunks synthesized at the same time, for all users
+MAX_WORKERS = 8
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='my_tts')
+
+# backends are tried in this order, the first one is the primary, only its voice messages are cached
+BACKEND_ORDER = ['google', 'espeak']
+# timeout of one gTTS request in seconds, gTTS waits forever by default
+GTTS_TIMEOUT = 10
+# espeak-ng voices for languages whose code differs from the translator's one
+ESPEAK_VOICES = {'zh': 'cmn', 'zh-TW': 'yue', 'iw': 'he', 'jw': 'jv'}
 
 
 # cleanup
@@ -18,6 +60,145 @@ for filePath in [x for x in glob.glob('*.wav') + glob.glob('*.ogg') if 'temp_tts
         my_log.log2(f"Error while deleting file : {filePath}\n\n{error}")
 
 
+class VoiceCache:
+    """Disk cache of voice messages with LRU eviction by total size. Last use time is kept
+    in the file mtime so the LRU order survives restarts."""
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.lock = threading.Lock()
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # {key: size} in LRU order
+        self.files = collections.OrderedDict()
+        self.total_bytes = 0
+        self.stats_counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+        if not os.path.exists(cache_dir):
+            os.mkdir(cache_dir)
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if not name.endswith('.ogg'):
+                # unfinished write
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        with self.lock:
+            for _, key, size in sorted(entries):
+                self.files[key] = size
+                self.total_bytes += size
+            self.evict()
+
+    @staticmethod
+    def make_key(text: str, lang: str) -> str:
+        return hashlib.sha256(f'{lang}\0{text}'.encode('utf-8')).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.ogg')
+
+    def evict(self) -> None:
+        """Removes least recently used files over the size budget, must be called with the lock held"""
+        while self.total_bytes > self.max_bytes and self.files:
+            key, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            self.stats_counters['evictions'] += 1
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, text: str, lang: str) -> bytes:
+        """Returns the cached voice message or None"""
+        key = self.make_key(text, lang)
+        with self.lock:
+            if key in self.files:
+                try:
+                    with open(self.path(key), 'rb') as f:
+                        data = f.read()
+                    os.utime(self.path(key))
+                    self.files.move_to_end(key)
+                    self.stats_counters['hits'] += 1
+                    return data
+                except FileNotFoundError:
+                    self.total_bytes -= self.files.pop(key)
+            self.stats_counters['misses'] += 1
+            return None
+
+    def put(self, text: str, lang: str, data: bytes) -> None:
+        """Saves the voice message, the file is replaced atomically"""
+        key = self.make_key(text, lang)
+        tmp_path = self.path(key) + f'.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            os.replace(tmp_path, self.path(key))
+            if key in self.files:
+                self.total_bytes -= self.files.pop(key)
+            self.files[key] = len(data)
+            self.total_bytes += len(data)
+            self.evict()
+
+    def stats(self) -> dict:
+        """Returns hit/miss/eviction counters and disk usage"""
+        with self.lock:
+            return dict(self.stats_counters, files=len(self.files), bytes=self.total_bytes)
+
+
+CACHE = VoiceCache(CACHE_DIR, CACHE_MAX_BYTES)
+
+
+# registered backends, see my_backends
+BACKENDS = my_backends.Registry('my_tts')
+
+
+def register_backend(name: str, function, timeout: float, workers: int = 8) -> None:
+    """
+    Registers a TTS backend, add its name to BACKEND_ORDER to use it.
+
+    Args:
+        name (str): The name of the backend.
+        function: function(text, lang) -> bytes, synthesizes the text in any format ffmpeg understands.
+        timeout (float): The time in seconds after which the next backend is tried.
+        workers (int): The maximum number of calls of the backend at the same time.
+    """
+    BACKENDS.register(name, function, timeout, workers)
+
+
+def backend_stats() -> dict:
+    """Returns stats of all registered backends {name: {calls, failures, timeouts, busy, healthy, latency_*}}"""
+    return BACKENDS.stats()
+
+
+def normalize(text: str) -> str:
+    """Normalizes the text so that the same phrase typed differently is synthesized and cached once"""
+    text = unicodedata.normalize('NFC', text)
+    lines = [' '.join(line.split()) for line in text.split('\n')]
+    return '\n'.join(line for line in lines if line)
+
+
+def to_ogg_opus(audio: bytes) -> bytes:
+    """
+    Transcodes audio to ogg/opus, the format of telegram voice messages, with ffmpeg.
+
+    Args:
+        audio (bytes): The audio in any format ffmpeg understands.
+
+    Returns:
+        bytes: The audio in ogg/opus or None if transcoding failed.
+    """
+    try:
+        result = my_proc.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0',
+                              '-c:a', 'libopus', '-b:a', OPUS_BITRATE, '-application', 'voip',
+                              '-f', 'ogg', 'pipe:1'],
+                             input=audio, timeout=FFMPEG_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as error:
+        my_log.log2(f'my_tts:to_ogg_opus: {error}')
+        return None
+    if result.returncode != 0 or not result.stdout:
+        my_log.log2(f'my_tts:to_ogg_opus: {result.stderr.decode("utf-8", errors="replace")[-500:]}')
+        return None
+    return result.stdout
+
+
 def tts_google(text: str, lang: str) -> bytes:
     """
     Converts the given text to speech using the Google Text-to-Speech (gTTS) API.
@@ -30,18 +211,182 @@ def tts_google(text: str, lang: str) -> bytes:
         bytes: The audio file in the form of bytes.
     """
     mp3_fp = io.BytesIO()
-    result = gtts.gTTS(text, lang=lang)
+    result = gtts.gTTS(text, lang=lang, timeout=GTTS_TIMEOUT)
     result.write_to_fp(mp3_fp)
     mp3_fp.seek(0)
     return mp3_fp.read()
 
 
+def split_text(text: str, max_len: int = CHUNK_LEN) -> list:
+    """
+    Splits the text into chunks up to max_len characters at sentence boundaries.
+    Sentences longer than max_len are split at spaces.
+
+    Args:
+        text (str): The text to be split.
+        max_len (int): The maximum length of a chunk.
+
+    Returns:
+        list: The chunks of the text in order.
+    """
+    pieces = []
+    for sentence in re.split(r'(?<=[.!?;:…。！？])\s+|\n+', text):
+        sentence = sentence.strip()
+        while len(sentence) > max_len:
+            cut = sentence.rfind(' ', 0, max_len + 1)
+            if cut <= 0:
+                cut = max_len
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            pieces.append(sentence)
+
+    chunks = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + 1 + len(piece) <= max_len:
+            chunks[-1] += ' ' + piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+def tts_google_long(text: str, lang: str) -> bytes:
+    """
+    Converts a long text to speech with gTTS, the chunks of the text are synthesized in parallel.
+    gTTS returns mp3 frames, so the chunks are concatenated in order as they are.
+
+    Args:
+        text (str): The text to be converted to speech.
+        lang (str): The language of the text.
+
+    Returns:
+        bytes: The audio file in the form of bytes or None if gTTS returned nothing.
+    """
+    chunks = split_text(text)
+    if len(chunks) < 2:
+        return tts_google(text, lang) or None
+    futures = [EXECUTOR.submit(tts_google, chunk, lang) for chunk in chunks]
+    try:
+        audio = b''.join(future.result() for future in futures)
+    finally:
+        # chunks that have not started are not needed if one of them failed
+        for future in futures:
+            future.cancel()
+    return audio or None
+
+
+def tts_espeak(text: str, lang: str) -> bytes:
+    """
+    Converts the given text to speech locally with espeak-ng.
+
+    Args:
+        text (str): The text to be converted to speech.
+        lang (str): The language of the text.
+
+    Returns:
+        bytes: The audio file in wav format or None if espeak-ng returned nothing.
+    """
+    voice = ESPEAK_VOICES.get(lang, lang)
+    result = my_proc.run(['espeak-ng', '-v', voice, '--stdout', '-b', '1', '--stdin'],
+                         input=text.encode('utf-8'), timeout=BACKENDS['espeak'].timeout)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf-8', errors='replace').strip())
+    return result.stdout or None
+
+
+register_backend('google', tts_google_long, timeout=30, workers=8)
+register_backend('espeak', tts_espeak, timeout=30, workers=4)
+
+
+def synthesize(text: str, lang: str) -> tuple:
+    """
+    Converts the text to speech with the first backend of BACKEND_ORDER that answers in time.
+
+    Args:
+        text (str): The text to be converted to speech.
+        lang (str): The language of the text.
+
+    Returns:
+        tuple: (audio bytes, backend name) or (None, '') if all backends failed.
+    """
+    return BACKENDS.run(BACKEND_ORDER, lang, text, lang)
+
+
 def tts(text: str, lang: str) -> bytes:
-    text = text.replace('\r','') 
-    text = text.replace('\n\n','\n')  
+    """
+    Converts the text to a voice message. Voice messages are transcoded to ogg/opus once
+    and served from the disk cache afterwards.
+
+    Args:
+        text (str): The text to be converted to speech.
+        lang (str): The language of the text.
+
+    Returns:
+        bytes: The voice message in ogg/opus, the backend's audio if transcoding failed
+            or None if all backends failed.
+    """
+    text = normalize(text)
+
+    data = CACHE.get(text, lang)
+    if data:
+        return data
+
+    audio, backend = synthesize(text, lang)
+    if not audio:
+        return None
+    data = to_ogg_opus(audio)
+    if not data:
+        return audio
+    # voice of a fallback backend is not cached so that the primary one is used when it recovers
+    if backend == BACKEND_ORDER[0]:
+        CACHE.put(text, lang, data)
+    return data
+
+
+def benchmark(port: int = 18096, delay: float = 0.15) -> None:
+    """
+    Measures latency of sequential and parallel synthesis against a local stub of the google
+    endpoint that answers every gTTS request (up to 100 characters) after the delay in seconds.
+    """
+    import base64
+    import http.server
+    import gtts.tts
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length'] or 0))
+            time.sleep(delay)
+            audio = base64.b64encode(b'\xff\xf3' + os.urandom(1000)).decode('ascii')
+            answer = f')]}}\'\n\n[["wrb.fr","jQ1olc","[\\"{audio}\\"]",null]]'.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(answer)))
+            self.end_headers()
+            self.wfile.write(answer)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    gtts.tts._translate_url = lambda tld='com', path='': f'http://127.0.0.1:{port}/{path}'
+    os.environ['no_proxy'] = '127.0.0.1'
 
-    return tts_google(text, lang)
+    sentence = 'The quick brown fox jumps over the lazy dog near the river bank. '
+    for length in (100, 500, 1000, 2000, 4000):
+        text = (sentence * (length // len(sentence) + 1))[:length]
+        results = []
+        for function in (tts_google, tts_google_long):
+            start = time.perf_counter()
+            function(text, 'en')
+            results.append(time.perf_counter() - start)
+        print(f'{length:5} chars: sequential {results[0]:6.2f} s, parallel {results[1]:6.2f} s, '
+              f'{results[0] / results[1]:5.1f}x')
+    server.shutdown()
 
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark()
\ No newline at end of file
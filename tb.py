@@ -7,7 +7,6 @@ import os
 import re
 import time
 import threading
-import tempfile
 
 import telebot
 
@@ -15,6 +14,7 @@ import cfg
 import my_bard
 import my_dic
 import my_log
+import my_strings
 import my_trans
 import my_tts
 import my_stt
@@ -35,41 +35,28 @@ if not os.path.exists('db'):
 
 
 # saved pairs of {user:(lang, token)}
-DB = my_dic.PersistentDict('db/db.pkl')
+if hasattr(cfg, 'db_engine') and cfg.db_engine == 'sqlite':
+    if not os.path.exists('db/db.sqlite') and os.path.exists('db/db.pkl'):
+        my_dic.migrate('db/db.pkl', 'db/db.sqlite')
+    DB = my_dic.SqliteDict('db/db.sqlite')
+else:
+    DB = my_dic.PersistentDict('db/db.pkl', journal=True)
 
 
-supported_langs_trans = [
-        "af","am","ar","az","be","bg","bn","bs","ca","ceb","co","cs","cy","da","de",
-        "el","en","eo","es","et","eu","fa","fi","fr","fy","ga","gd","gl","gu","ha",
-        "haw","he","hi","hmn","hr","ht","hu","hy","id","ig","is","it","iw","ja","jw",
-        "ka","kk","km","kn","ko","ku","ky","la","lb","lo","lt","lv","mg","mi","mk",
-        "ml","mn","mr","ms","mt","my","ne","nl","no","ny","or","pa","pl","ps","pt",
-        "ro","ru","rw","sd","si","sk","sl","sm","sn","so","sq","sr","st","su","sv",
-        "sw","ta","te","tg","th","tl","tr","uk","ur","uz","vi","xh","yi","yo","zh",
-        "zh-TW","zu"]
+# translation backend, see my_trans.BACKEND
+if hasattr(cfg, 'trans_backend'):
+    my_trans.BACKEND = cfg.trans_backend
 
+# tts backends in order of preference, see my_tts.BACKEND_ORDER
+if hasattr(cfg, 'tts_backends'):
+    my_tts.BACKEND_ORDER = cfg.tts_backends
 
-HELP = r'''You need to get a google bard token to talk with Bard.
 
-1. Install Cookie-Editor extension.
-
-2. Go to https://bard.google.com and login, you may need to use a VPN to access Bard in countries where it is not available.
-
-3. Click on the extension icon and copy a token starting with [__Secure-1PSID]
-Ensure you are copying the correct token corresponding to the account number, which can be found in the URL as bard.google.com/u/{account_number}.
-If your account number is /u/2, search for the token named __Secure-2PSID.
-If your account number is /u/3, search for the token named __Secure-3PSID.
-Try new account if this fail.
-
-4. Paste the token in the bot as [/token xxx...xxx]. 
-
-You can set a token for group by coping the personal token, use [/token copy] command in chat.
-
-Other bots:
-chatGPT - @chat_GPT_free_007_bot
-all-in-one - @kun4sun_bot
-translator - @chats_translator_bot
-'''
+# speech recognition backends in order of preference and local models, see my_stt.BACKEND_ORDER
+if hasattr(cfg, 'stt_backends'):
+    my_stt.BACKEND_ORDER = cfg.stt_backends
+if hasattr(cfg, 'vosk_models'):
+    my_stt.VOSK_MODELS = cfg.vosk_models
 
 
 class ShowAction(threading.Thread):
@@ -155,13 +142,10 @@ def send_welcome_start(message: telebot.types.Message):
     if user_id not in DB:
         DB[user_id] = (default_lang, token)
 
-    if lang != 'en':
-        translated = my_trans.translate(HELP, lang)
-    else:
-        translated = HELP
+    translated = my_strings.tr(my_strings.HELP, lang)
 
     bot.reply_to(message, html.escape(translated), parse_mode='HTML', disable_web_page_preview=True)
-    my_log.log_echo(message, HELP)
+    my_log.log_echo(message, my_strings.HELP)
 
 
 @bot.message_handler(commands=['language', 'lang'])
@@ -234,6 +218,9 @@ def set_default_commands(message: telebot.types.Message) -> None:
                  'ja', 'ko', 'nl', 'no', 'pl', 'pt', 'ro', 'ru', 'sv', 'sw', 'th', 'tr', 'uk', 'ur',
                  'vi', 'zh']
 
+    # all translations at once, in parallel
+    translations = my_trans.translate_many([new_description, new_short_description], languages)
+
     try:
         if not bot.set_my_name(bot_name):
             my_log.log2(f'Failed to set bot name: {bot_name}')
@@ -247,7 +234,9 @@ def set_default_commands(message: telebot.types.Message) -> None:
         my_log.log2(f'Failed to set bot description: {error_set_description}')
 
     for i in languages:
-        translated = my_trans.translate(new_description, i)
+        translated = translations[(new_description, i)]
+        if not translated:
+            continue
         try:
             if not bot.set_my_description(translated, language_code=i):
                 my_log.log2(f'Failed to set bot description: {translated}')
@@ -261,7 +250,9 @@ def set_default_commands(message: telebot.types.Message) -> None:
         my_log.log2(f'Failed to set bot short description: {error_set_short_description}')
 
     for i in languages:
-        translated = my_trans.translate(new_short_description, i)
+        translated = translations[(new_short_description, i)]
+        if not translated:
+            continue
         try:
             if not bot.set_my_short_description(translated, language_code=i):
                 my_log.log2(f'Failed to set bot short description: {translated}')
@@ -294,10 +285,7 @@ def token(message: telebot.types.Message) -> None:
     except IndexError:
         pass
 
-    if lang != 'en':
-        translated = my_trans.translate(HELP, lang)
-    else:
-        translated = HELP
+    translated = my_strings.tr(my_strings.HELP, lang)
 
     bot.reply_to(message, html.escape(translated), parse_mode='HTML', disable_web_page_preview=True)
     return
@@ -319,9 +307,7 @@ def removeme(message: telebot.types.Message):
         return
     else:
         lang = message.from_user.language_code or 'en'
-        msg = 'User not found.'
-        if lang != 'en':
-            msg = my_trans.translate(msg, lang)
+        msg = my_strings.tr(my_strings.USER_NOT_FOUND, lang)
         bot.reply_to(message, msg)
         my_log.log_echo(message, msg)
 
@@ -346,27 +332,25 @@ def handle_voice_thread(message: telebot.types.Message):
         return
     lang = DB[user_id][0]
 
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        file_path = temp_file.name
-    try:
-        file_info = bot.get_file(message.voice.file_id)
-    except AttributeError:
-        file_info = bot.get_file(message.audio.file_id)
-    downloaded_file = bot.download_file(file_info.file_path)
-    with open(file_path, 'wb') as new_file:
-        new_file.write(downloaded_file)
+    media = message.voice or message.audio
 
     with ShowAction(message, 'typing'):
-        text = my_stt.stt(file_path, lang)
-        os.remove(file_path)
-        text = text.strip()
+        # the same file forwarded or sent again is recognized once
+        text = my_stt.TRANSCRIPTS.get(media.file_unique_id, lang)
+        if text is None:
+            start_time = time.time()
+            file_info = bot.get_file(media.file_id)
+            downloaded_file = bot.download_file(file_info.file_path)
+            text, complete = my_stt.transcribe(downloaded_file, lang)
+            text = text.strip()
+            # a transcript with missing segments is not cached, the next forward gets another try
+            if text and complete:
+                my_stt.TRANSCRIPTS.put(media.file_unique_id, lang, text, len(downloaded_file), time.time() - start_time)
         if text:
             reply_to_long_message(message, text)
             my_log.log_echo(message, f'[ASR] {text}')
         else:
-            msg = 'Did not recognize any text.'
-            if lang != 'en':
-                msg = my_trans.translate(msg, lang)
+            msg = my_strings.tr(my_strings.NO_TEXT_RECOGNIZED, lang)
             bot.reply_to(message, msg)
             my_log.log_echo(message, '[ASR] no results')
 
@@ -402,22 +386,23 @@ def tts_thread(message: telebot.types.Message):
         pass
 
     if not text:
-        msg = '@tts text to say with google voice'
-        if lang != 'en':
-            msg = my_trans.translate(msg, lang) or msg
-        msg = msg.replace('@', '/')
+        msg = my_strings.tr(my_strings.TTS_HELP, lang).replace('@', '/')
         bot.reply_to(message, msg)
         return
 
+    if len(text) > my_tts.MAX_TEXT_LEN:
+        msg = my_strings.tr(my_strings.TTS_TOO_LONG, lang, length=len(text), max_length=my_tts.MAX_TEXT_LEN)
+        bot.reply_to(message, msg)
+        my_log.log_echo(message, msg)
+        return
+
     with ShowAction(message, 'record_audio'):
         audio = my_tts.tts(text, lang)
         if audio:
             bot.send_voice(message.chat.id, audio, reply_to_message_id = message.message_id)
             my_log.log_echo(message, '[Send voice message]')
         else:
-            msg = 'TTS failed.'
-            if lang != 'en':
-                msg = my_trans.translate(msg, lang)
+            msg = my_strings.tr(my_strings.TTS_FAILED, lang)
             bot.reply_to(message, msg)
             my_log.log_echo(message, msg)
 
@@ -440,20 +425,11 @@ def trans_thread(message: telebot.types.Message):
     else:
         user_lang = message.from_user.language_code or 'en'
 
-    help = f"""@trans [en|ru|uk|..] text to be translated into the specified language
-
-If not specified, then your language will be used.
-
-@trans de hi, how are you?
-@trans was ist das
-
-Supported languages: """
-    if user_lang != 'en':
-        help = my_trans.translate(help, user_lang)
+    help = my_strings.tr(my_strings.TRANS_HELP, user_lang)
     help = help.replace('@', '/')
-    help += ' ' + ', '.join(supported_langs_trans)
+    help += ' ' + ', '.join(my_strings.supported_langs_trans)
 
-    pattern = r'^\/trans\s+((?:' + '|'.join(supported_langs_trans) + r')\s+)?\s*(.*)$'
+    pattern = r'^\/trans\s+((?:' + '|'.join(my_strings.supported_langs_trans) + r')\s+)?\s*(.*)$'
 
     match = re.match(pattern, message.text, re.DOTALL)
 
@@ -472,9 +448,7 @@ Supported languages: """
             bot.reply_to(message, translated)
             my_log.log_echo(message, translated)
         else:
-            msg = 'Ошибка перевода'
-            if lang != 'en':
-                msg = my_trans.translate(msg, lang)
+            msg = my_strings.tr(my_strings.TRANS_FAILED, lang)
             bot.reply_to(message, msg)
             my_log.log_echo(message, msg)
 
@@ -542,20 +516,24 @@ def clear_thread(message):
     if user_id in DB:
         lang = DB[user_id][0]
         my_bard.reset_bard_chat(user_id)
-        translated = 'New dialog started.'
-        if lang != 'en':
-            translated = my_trans.translate(translated, lang)
+        my_bard.prewarm(user_id, DB[user_id][1], lang, get_user_name(message))
+        translated = my_strings.tr(my_strings.NEW_DIALOG, lang)
         bot.reply_to(message, translated)
         my_log.log_echo(message, translated)
     else:
-        translated = 'You have to provide a token. Use [/token] command.'
         lang = message.from_user.language_code or 'en'
-        if lang != 'en':
-            translated = my_trans.translate(translated, lang)
+        translated = my_strings.tr(my_strings.NEED_TOKEN, lang)
         bot.reply_to(message, translated)
         my_log.log_echo(message, translated)
 
 
+def get_user_name(message: telebot.types.Message) -> str:
+    """Returns the name that is sent to bard, the user's name in private chats or the chat name"""
+    if message.chat.type == 'private':
+        return (message.from_user.first_name or '') + ' ' + (message.from_user.last_name or '')
+    return '(public chat, it is not person) ' + (message.chat.username or message.chat.first_name or message.chat.title or 'noname')
+
+
 @bot.message_handler(func=lambda message: True)
 def echo_all(message: telebot.types.Message) -> None:
     """Text message handler"""
@@ -573,15 +551,9 @@ def do_task(message):
         user_id = chat_id
 
     if user_id not in DB or DB[user_id][1] == '':
-        if is_private:
-            msg = 'You have to provide a token. Use [/token] command.'
-        else:
-            msg = 'You have to provide a token. Use [/token copy] command to copy your private token.'
+        msg = my_strings.NEED_TOKEN if is_private else my_strings.NEED_TOKEN_GROUP
         lang = message.from_user.language_code or 'en'
-        if lang != 'en':
-            translated = my_trans.translate(msg, lang)
-        else:
-            translated = msg
+        translated = my_strings.tr(msg, lang)
         bot.reply_to(message, translated, parse_mode='HTML')
         my_log.log_echo(message)
         my_log.log_echo(message, translated)
@@ -597,24 +569,25 @@ def do_task(message):
     my_log.log_echo(message)
     msg = message.text
     if len(msg) > my_bard.MAX_REQUEST:
-        msg = f'Message too long for bard: {len(msg)} of {my_bard.MAX_REQUEST}'
-        if lang != 'en':
-            translated = my_trans.translate(msg, lang)
-        else:
-            translated = msg
+        translated = my_strings.tr(my_strings.BARD_TOO_LONG, lang, length=len(msg), max_length=my_bard.MAX_REQUEST)
         bot.reply_to(message, translated)
         my_log.log_echo(message, translated)
         return
     with ShowAction(message, 'typing'):
         try:
-            if is_private:
-                user_name = (message.from_user.first_name or '') + ' ' + (message.from_user.last_name or '')
-            else:
-                user_name = '(public chat, it is not person) ' + (message.chat.username or message.chat.first_name or message.chat.title or 'noname')
-            answer = my_bard.chat(message.text, user_id, token, lang, user_name)
-            if not answer:
-                # 1 more try
+            user_name = get_user_name(message)
+            # retries are done by my_bard.RETRY
+            try:
                 answer = my_bard.chat(message.text, user_id, token, lang, user_name)
+            except my_bard.BusyError as busy_error:
+                my_log.log2(str(busy_error))
+                translated = my_strings.tr(my_strings.BARD_BUSY, lang)
+                bot.reply_to(message, translated)
+                my_log.log_echo(message, translated)
+                return
+            if answer is None:
+                # the message was sent to bard together with a previous one and answered there
+                return
             answer = utils.bot_markdown_to_html(answer)
             my_log.log_echo(message, answer)
             if answer:
@@ -625,9 +598,7 @@ def do_task(message):
                     my_log.log2(f'tb:do_task: {error}')
                     reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True)
             else:
-                translated = 'Bard did not answer. May be you need to renew your token.'
-                if lang != 'en':
-                    translated = my_trans.translate(translated, lang)
+                translated = my_strings.tr(my_strings.BARD_NO_ANSWER, lang)
                 bot.reply_to(message, translated)
         except Exception as error3:
             print(error3)
@@ -640,6 +611,8 @@ def main():
     Runs the main function, which sets default commands and starts polling the bot.
     """
     # set_default_commands()
+    my_bard.prewarm_recent(lambda x: DB[x][1] if x in DB else '')
+    threading.Thread(target=my_stt.preload, daemon=True).start()
     bot.polling(timeout=90, long_polling_timeout=90)
 
 